@@ -0,0 +1,214 @@
+# Micro-benchmarks for the HRR and HDM hot paths
+#
+# times HRR binding / compare / permute, Cleanup.add / clean, Vocabulary.text,
+# HDM.add, HDM.request (for a value and by resonance), get_activation and addNoise
+# over a grid of vector dimensionality (N), vocabulary size and chunk length
+#
+# usage:
+#     python bench_hdm.py                               run the default grid, write results.json
+#     python bench_hdm.py --quick                       run a small grid
+#     python bench_hdm.py --save-baseline               also store the results as the baseline
+#     python bench_hdm.py --baseline baseline.json      flag benchmarks slower than the baseline
+#
+# results are written as JSON, one record per benchmark:
+#     {"name": ..., "N": ..., "vocab": ..., "length": ..., "seconds": time per call, "calls": ...}
+# a benchmark is flagged as a regression if it takes more than (1 + tolerance) times
+# its baseline time, and the script then exits with status 1
+# timings depend on the machine, so no baseline is committed: make one with --save-baseline
+# on the same machine, from the version to compare against (see BENCHMARKS in README.md)
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import numpy
+
+from ccm.lib.hrr import HRR, Cleanup, Vocabulary
+from ccm.lib.actr.hdm import HDM
+from ccm.lib.actr.buffer import Buffer
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# time fn, returns the best time per call over repeat runs of number calls each
+def measure(fn, number, repeat):
+    best = None
+    for r in range(repeat):
+        start = timeit.default_timer()
+        for i in range(number):
+            fn()
+        elapsed = (timeit.default_timer() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# a vocabulary of words w0 ... w(vocab-1)
+def words(vocab):
+    return ['w%d' % i for i in range(vocab)]
+
+# chunks of length words drawn at random from the vocabulary
+def chunks(vocab, length, count, rng):
+    w = words(vocab)
+    return [' '.join([w[i] for i in rng.randint(0, vocab, length)]) for c in range(count)]
+
+# an HDM with N dimensions that has learned chunks of the given length
+# (older versions of HDM, which have no seed or add_many, are seeded through numpy.random
+# and learn one chunk at a time, so that a baseline can be made before either existed)
+def memory(N, vocab, length, rng, seed):
+    try:
+        m = HDM(Buffer(), N=N, seed=seed)
+    except TypeError:
+        numpy.random.seed(seed)
+        m = HDM(Buffer(), N=N)
+    # retrieved chunks are not placed in a buffer, only the retrieval itself is timed
+    m.recall = lambda chunk, matches, request_number: None
+    m.fail = lambda request_number: None
+    learned = chunks(vocab, length, vocab, rng)
+    if hasattr(m, 'add_many'):
+        m.add_many(learned)
+    else:
+        for chunk in learned:
+            m.add(chunk)
+    return m
+
+
+# HRR benchmarks depend only on N
+def bench_hrr(N, number, repeat, seed):
+    rng = numpy.random.RandomState(seed)
+    a = HRR(data=rng.randn(N) / numpy.sqrt(N))
+    b = HRR(data=rng.randn(N) / numpy.sqrt(N))
+    p = rng.permutation(N)
+    return [('hrr.bind', measure(lambda: HRR(data=a.v) * HRR(data=b.v), number, repeat)),
+            ('hrr.compare', measure(lambda: a.compare(b), number, repeat)),
+            ('hrr.permute', measure(lambda: a.permute(p), number, repeat))]
+
+# Cleanup and Vocabulary benchmarks depend on N and the vocabulary size
+def bench_cleanup(N, vocab, number, repeat, seed, text_limit):
+    rng = numpy.random.RandomState(seed)
+    hrrs = [HRR(data=rng.randn(N)) for i in range(vocab)]
+    def fill():
+        c = Cleanup()
+        for h in hrrs:
+            c.add(h)
+        return c
+    c = fill()
+    probe = hrrs[0] + HRR(data=rng.randn(N) / numpy.sqrt(N))
+    results = [('cleanup.add', measure(fill, 1, repeat) / vocab),
+               ('cleanup.clean', measure(lambda: c.clean(probe), number, repeat))]
+    # Vocabulary.text compares the probe to every pair of atoms, so it is only timed for small vocabularies
+    if vocab <= text_limit:
+        try:
+            v = Vocabulary(N, seed=seed)
+        except TypeError:
+            numpy.random.seed(seed)
+            v = Vocabulary(N)
+        for w in words(vocab):
+            v[w]
+        probe = v['w0'] * v['w1']
+        results.append(('vocabulary.text', measure(lambda: v.text(probe), 1, repeat)))
+    return results
+
+# HDM benchmarks depend on N, the vocabulary size and the chunk length
+def bench_hdm(N, vocab, length, number, repeat, seed):
+    rng = numpy.random.RandomState(seed)
+    m = memory(N, vocab, length, rng, seed)
+    new = chunks(vocab, length, number, rng)
+    learned = chunks(vocab, length, number, rng)
+    queries = [' '.join(['?'] + c.split()[1:]) for c in learned]
+    state = {'i': 0}
+    # step through a list of chunks, one per call
+    def each(fn, items):
+        def call():
+            fn(items[state['i'] % len(items)])
+            state['i'] += 1
+        return call
+    def request(chunk):
+        m.busy = False
+        m.request(chunk)
+    def get_activation(chunk):
+        m.busy = False
+        m.get_activation(chunk)
+    # noise of 0.01 per call: 0.01 seconds of simulated time at noise 1.0
+    def addNoise():
+        m.lastUpdate = m.now() - 0.01
+        m.addNoise()
+    results = [('hdm.add', measure(each(m.add, new), number, repeat)),
+               ('hdm.request.value', measure(each(request, queries), number, repeat)),
+               ('hdm.request.resonance', measure(each(request, learned), number, repeat)),
+               ('hdm.get_activation', measure(each(get_activation, learned), number, repeat))]
+    # noise is only turned on now, so that it is not added by the benchmarks above
+    m.noise = 1.0
+    results.append(('hdm.addNoise', measure(addNoise, number, repeat)))
+    return results
+
+
+def run(Ns, vocabs, lengths, number, repeat, seed, text_limit):
+    results = []
+    def record(name, seconds, N, vocab=None, length=None):
+        results.append({'name': name, 'N': N, 'vocab': vocab, 'length': length,
+                        'seconds': seconds, 'calls': number})
+        print '%-24s N=%-5d vocab=%-6s length=%-4s %12.3f us' % (name, N, vocab or '-', length or '-', seconds * 1e6)
+        sys.stdout.flush()
+    for N in Ns:
+        for name, seconds in bench_hrr(N, number, repeat, seed):
+            record(name, seconds, N)
+        for vocab in vocabs:
+            for name, seconds in bench_cleanup(N, vocab, number, repeat, seed, text_limit):
+                record(name, seconds, N, vocab)
+            for length in lengths:
+                for name, seconds in bench_hdm(N, vocab, length, number, repeat, seed):
+                    record(name, seconds, N, vocab, length)
+    return results
+
+def key(r):
+    return (r['name'], r['N'], r['vocab'], r['length'])
+
+# compare results to a baseline, returns the list of regressions
+def compare(results, baseline, tolerance):
+    old = dict([(key(r), r['seconds']) for r in baseline])
+    regressions = []
+    for r in results:
+        if key(r) not in old: continue
+        ratio = r['seconds'] / old[key(r)]
+        r['baseline'] = old[key(r)]
+        r['ratio'] = ratio
+        if ratio > 1.0 + tolerance:
+            regressions.append(r)
+            print 'REGRESSION %-24s N=%-5d vocab=%-6s length=%-4s %.2fx slower' % (r['name'], r['N'], r['vocab'] or '-', r['length'] or '-', ratio)
+    return regressions
+
+def integers(text):
+    return [int(i) for i in text.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for HRR and HDM')
+    parser.add_argument('--N', type=integers, default=[64, 256, 1024, 4096], help='comma separated vector dimensionalities')
+    parser.add_argument('--vocab', type=integers, default=[100, 1000], help='comma separated vocabulary sizes')
+    parser.add_argument('--length', type=integers, default=[2, 4, 8], help='comma separated chunk lengths')
+    parser.add_argument('--number', type=int, default=20, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per benchmark (the best is kept)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--text-limit', type=int, default=100, help='largest vocabulary for which Vocabulary.text is timed')
+    parser.add_argument('--quick', action='store_true', help='run a small grid: N=64,256 vocab=100 length=2,4')
+    parser.add_argument('--output', default=os.path.join(here, 'results.json'))
+    parser.add_argument('--baseline', default=None, help='results file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slow down allowed before a regression is flagged')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.N, args.vocab, args.length = [64, 256], [100], [2, 4]
+
+    results = run(args.N, args.vocab, args.length, args.number, args.repeat, args.seed, args.text_limit)
+    regressions = []
+    if args.baseline is not None:
+        regressions = compare(results, json.load(open(args.baseline)), args.tolerance)
+    json.dump(results, open(args.output, 'w'), indent=1, sort_keys=True)
+    if args.save_baseline:
+        json.dump(results, open(os.path.join(here, 'baseline.json'), 'w'), indent=1, sort_keys=True)
+    if regressions:
+        print len(regressions), 'regressions'
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
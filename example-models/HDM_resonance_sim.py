@@ -9,6 +9,9 @@ import ccm
 from ccm.lib.actr import *
 import CFlib
 import time
+import random
+import numpy
+import multiprocessing
 from ccm.lib.actr.hdm import *
 #****************
 # Utilities
@@ -20,9 +23,8 @@ class FanModel(ACTR):
     memory=HDM(retrieval,latency=0.63,verbose=False,N=256)
     def LoadFile(self, fn='hdm_data1.txt'): 
         try:
-            datalist=[data.strip() for data in open(fn,'r').readlines()]
-            for r in datalist:
-                self.memory.add(r)
+            # stream the file into memory in blocks rather than one add per line
+            self.memory.add_file(fn)
         except:
             print "Can't open file."
             self.stop()
@@ -56,6 +58,8 @@ class FanModel(ACTR):
 
 # the experiment
 class FanTest(ccm.Model):
+    # log each trial (set by run_subject)
+    logstatus=False
     def start(self):
         global fd
         # Experiment records
@@ -96,7 +100,7 @@ class FanTest(ccm.Model):
             except:
                 fanl='1'
             # log answers
-            if app.logstatus.get():
+            if self.logstatus:
                 log.CFRT[item,str(rt)]=value
             # each trial: for no error
             if ans:
@@ -133,14 +137,10 @@ class FanTest(ccm.Model):
                 exprecs.append(frmt_rec)
             
         
-        # options for the experiment
-        if app.logf.get():
-            lf='Fresults.csv'
-            self.fwll2csv(exprecs,lf)
-        #plotxy(x_in,y_in,sym = 'ro', xl='Total Fan',
-        #yl='RT (sec.)',tl='CF Experiment',fn='CFRT.png',grid=True, ll='RT (sec.)')    
-        if app.plot.get():
-            CFlib.plotxy(xlist,rtlist)
+        # keep the records for run_trial, which writes and plots them
+        self.exprecs=exprecs
+        self.xlist=xlist
+        self.rtlist=rtlist
 
     def sayYes(self):
         global yescount, ans
@@ -153,34 +153,81 @@ class FanTest(ccm.Model):
         ans=False
 
         
-    # 1)write a list to a csv file
-    def fwl2csv(self,ilist,ofn):
-        ''' input: ilist = [1,2,a,b] and out-file name, output: a csv file'''
-        wf = open (ofn,'a')
-        for item in ilist:
-            if  isinstance(item,str):
-                wf.write(item+',')
-            else:
-                wf.write(str(item)+',')
-        wf.write('\n')
-        wf.close()
-
-    # 2)write a list of lists to a csv file using fwl2csv
-    def fwll2csv(self,ilist,ofn):
-        for item in ilist:
-            self.fwl2csv(item,ofn)
+# write a list to an open csv file
+def fwl2csv(ilist,wf):
+    ''' input: ilist = [1,2,a,b] and an open file, output: a csv record'''
+    for item in ilist:
+        if  isinstance(item,str):
+            wf.write(item+',')
+        else:
+            wf.write(str(item)+',')
+    wf.write('\n')
+
+# subjects are run in parallel, each with its own seed derived from master_seed,
+# so a run can be reproduced no matter which worker process runs which subject
+# workers is the number of worker processes (None uses one per CPU)
+master_seed=2014
+workers=None
+
+# derive a reproducible seed for each of n subjects from the master seed
+# (subject t always gets the same seed, however many subjects are run)
+def subject_seeds(master,n):
+    return numpy.random.RandomState(master).randint(0,2**31-1,size=n)
+
+# run one subject in a worker process and return its results
+def run_subject(args):
+    global nocount, yescount
+    subject,seed,logstatus=args
+    numpy.random.seed(seed)
+    random.seed(seed)
+    nocount, yescount=0.0,0.0
+    env=FanTest()
+    env.logstatus=logstatus
+    env.model=FanModel()
+    # the memory was made with the class, before the seed was known,
+    # so its placeholder and permutation are drawn again from the seed
+    env.model.memory.reseed(seed)
+    env.run()
+    return subject,yescount,nocount,env.exprecs,env.xlist,env.rtlist
+
+# check that a subject run twice with the same seed gives the same RTs and accuracy, e.g.,
+#     python -c "import HDM_resonance_sim as sim; sim.check_seed(2014)"
+def check_seed(seed,logstatus=False):
+    first=run_subject((1,seed,logstatus))
+    second=run_subject((1,seed,logstatus))
+    # (the records also hold the date, so only the RTs and answers are compared)
+    assert first[1:3]==second[1:3], 'accuracy differs: %s %s' % (first[1:3],second[1:3])
+    assert first[5]==second[5], 'RTs differ'
+    print 'seed',seed,'is reproducible: yes',first[1],'no',first[2]
 
 # used by: App.run_exp
 def run_trial():
     #root.update()
-    global nocount, yescount
-    print 'No. of subjects: ',app.s_n.get()
-    for t in range(1, app.s_n.get()+1):
-        nocount, yescount=0.0,0.0
-        env=FanTest()
-        env.model=FanModel()
-        env.run()
-        print 'yes: ',yescount,'no: ',nocount,'error%: ',(nocount/(nocount+yescount))*100
+    n=app.s_n.get()
+    print 'No. of subjects: ',n
+    seeds=subject_seeds(master_seed,n)
+    jobs=[(t,seeds[t-1],app.logstatus.get()) for t in range(1, n+1)]
+    # one buffered writer for the records of all subjects
+    wf=None
+    if app.logf.get():
+        wf=open('Fresults.csv','a')
+    pool=multiprocessing.Pool(workers)
+    try:
+        # results arrive in subject order as soon as each subject is done
+        for t,yes,no,exprecs,xlist,rtlist in pool.imap(run_subject,jobs):
+            print 'subject',t,'yes: ',yes,'no: ',no,'error%: ',(no/(no+yes))*100
+            if wf is not None:
+                for rec in exprecs:
+                    fwl2csv(rec,wf)
+            #plotxy(x_in,y_in,sym = 'ro', xl='Total Fan',
+            #yl='RT (sec.)',tl='CF Experiment',fn='CFRT.png',grid=True, ll='RT (sec.)')    
+            if app.plot.get():
+                CFlib.plotxy(xlist,rtlist)
+    finally:
+        pool.close()
+        pool.join()
+        if wf is not None:
+            wf.close()
 
     
 #GUI and Main   
@@ -224,6 +271,9 @@ wd = CFlib.f2wd('hdm_probes.txt')
 for line in open('hdm_probes.txt','r').readlines():
     fd =CFlib.line2fdict(line.strip(),wd)
 
-root = Tk(className=" HDM Fan Experiment")
-app = App(root)
-root.mainloop()
+# the GUI only runs in the main process: worker processes (which import this file
+# on platforms that spawn them, e.g. Windows) need the experiment, not the window
+if __name__=='__main__':
+    root = Tk(className=" HDM Fan Experiment")
+    app = App(root)
+    root.mainloop()
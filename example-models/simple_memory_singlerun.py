@@ -17,6 +17,11 @@ from ccm.lib.hrr import HRR
 class MyEnvironment(ccm.Model):
     display     = ccm.Model(word="START")
     
+    # record the activation of the test item every 100ms for 30 seconds
+    def start(self):
+        if self.agent.Use_HDM:
+            self.recorder = self.agent.DM.record(['test item'],interval=0.1,samples=300)
+
     # start presenting the list
     def start_list(self):
         times = [0.7090, 3.8111, 6.9672, 9.8382, 18.2230, 18.7200, 19.0000, 24.0890, 29.4293, 29.9843]
@@ -66,15 +71,20 @@ activation = []
 
 print "Run ACT-R"
 
-#for i in range(0,300):
-while subway.display.word != "OFF":
-    subway.run(limit=0.1)   # run simulation for 100ms
-    times.append(subway.now())
-    try:
-        a = subway.agent.DM.get_activation('test item')
-    except:
-        a = 0.0
-    activation.append(a)
+if subway.agent.Use_HDM:
+    subway.run()            # HDM samples the activations as the simulation runs
+    times, activations = subway.recorder.results()
+    activation = list(activations[:,0])
+else:
+    #for i in range(0,300):
+    while subway.display.word != "OFF":
+        subway.run(limit=0.1)   # run simulation for 100ms
+        times.append(subway.now())
+        try:
+            a = subway.agent.DM.get_activation('test item')
+        except:
+            a = 0.0
+        activation.append(a)
 ccm.finished()                             # stop the environment
 
 if subway.agent.Use_HDM:
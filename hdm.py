@@ -40,20 +40,54 @@
 # get_activation(chunk):
 #       Computes the coherence of a chunk, which used in request type 2.
 #       Returns a mean cosine.
+#
+# To record activations over time (e.g., a forgetting curve), call from a production or process:
+# record(probes,interval,samples): returns a Recorder that computes the activation
+#       of every probe chunk every interval seconds, inside the scheduler
 
 from __future__ import generators
 import ccm
 import math
 import numpy
 import copy
+import csv
+import json
+import os
+import tempfile
+import time
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-__all__=['HDM']
+__all__=['HDM','Stats','Recorder','ChunkTemplate','DiskMemoryStore','read_chunks']
 
 from ccm.lib.actr.buffer import Chunk,Buffer
 # add for hdm
 from ccm.lib.actr.dm import Memory
 from ccm.pattern import Pattern
-from ccm.lib.hrr import HRR
+from ccm.lib.hrr import HRR,SparseHRR,RandomPool,fft_real,fft_inverse,complex_dtype
+from numpy.linalg import norm
+
+# timed(name) wraps a function of HDM so that, when the HDM has stats,
+# its calls and running time are added to the timer called name (see Stats)
+# the wrapper is part of the class, so it still times the function
+# after ccm copies the HDM into a model and wraps its methods
+def timed(name):
+  def wrap(function):
+    def timedFunction(self,*args,**keys):
+      stats=getattr(self,'stats',None)
+      if stats is None:
+        return function(self,*args,**keys)
+      start=time.time()
+      try:
+        return function(self,*args,**keys)
+      finally:
+        stats.addTime(name,time.time()-start)
+    timedFunction.__name__=function.__name__
+    timedFunction.__doc__=function.__doc__
+    return timedFunction
+  return wrap
 
 class HDM(Memory):
   # buffer is the buffer that the retrieved chunk is placed in
@@ -84,17 +118,102 @@ class HDM(Memory):
   #     Noise ranges from [0 ... ]
   #     where 0 is no noise
   #     and more is more noise
+  # retention is the fraction of each memory vector retained per second, defaults to 1 (no decay)
+  #     range (0 to 1]
+  #     Memory vectors decay with time:
+  #     memory vector = retention ^ (time since last update) * memory vector
+  #     Decay is tracked by a decay clock and only applied to a memory vector when it is next
+  #     updated or read (noise is added to the decayed vector), so it costs nothing for unused vectors.
+  #     Decay does not change the cosine of a memory vector with a query by itself,
+  #     but it weights new information (and noise) more heavily than old.
+  # lazy_noise defaults to FALSE.
+  #     If TRUE, the noise owed to each memory vector is tracked as an accumulated variance
+  #     and only drawn when that memory vector is next read or compared,
+  #     as one Gaussian vector with the accumulated variance (in one batched draw for all pending vectors).
+  #     This is approximately, not exactly, the same in distribution as adding the noise at every Request or Add
+  #     (which adds a sum of scaled unit-length vectors, where lazy noise draws one Gaussian vector),
+  #     but costs nothing for memory vectors that are not used.
+  # cache_size is the number of open n-gram vectors kept in an LRU cache (0 turns the cache off)
+  #     The vector for a chunk with a placeholder, e.g., 'a ? c', is the same whether it is
+  #     built to add 'a b c' to memory or to request 'a ? c', so it is only built once.
+  #     Cached vectors are dropped when set redefines a value they use.
+  #     self.ngrams.hits and self.ngrams.misses count cache hits and misses.
+  # dtype is the floating point type used to store vectors, defaults to numpy.float64
+  #     numpy.float32 halves the memory needed for environment and memory vectors
+  #     and the time taken to scan memory (FFTs are also done in single precision if scipy is installed)
+  # accumulate_dtype is the floating point type used where values are accumulated, defaults to numpy.float64
+  #     i.e., when building open n-gram vectors, updating memory vectors, and computing vector lengths.
+  #     The results are stored as dtype.
+  # seed is the seed of this memory's own random number generator, defaults to None
+  #     All environment vectors, slot permutations and noise are drawn from this generator,
+  #     in blocks, so models running side by side do not share (or disturb) one random state.
+  #     If None, the seed is drawn from numpy.random (so numpy.random.seed still makes runs repeatable).
+  # stats defaults to FALSE.
+  #     If TRUE, self.stats counts the work HDM does (convolutions, FFTs, cosines computed,
+  #     noise vectors drawn, n-gram cache hits and misses, new environment vectors and memory rows)
+  #     and times add, add_many, request, request_many, get_activation, get_activation_many and addNoise.
+  #     self.stats.snapshot() returns the counts and times as a dictionary,
+  #     self.stats.dump(filename) appends them to a file and self.stats.reset() sets them to zero.
+  #     If FALSE, self.stats is None and nothing is counted or timed.
+  # lsh_tables is the number of hash tables of an approximate index over memory vectors, defaults to 0 (no index)
+  #     With an index, a request for a value only computes the cosines of the memory vectors
+  #     that hash to the same bucket as the query (random-hyperplane LSH), rather than of all of memory.
+  #     The best of these candidates is then chosen exactly as without the index,
+  #     i.e., the threshold, inhibited values and finst are all still honoured,
+  #     but the best match in all of memory can be missed if it is not a candidate.
+  #     More tables, fewer bits or more probes find more of the true best matches (better recall)
+  #     at the cost of more candidates (slower requests).
+  # lsh_bits is the number of hyperplanes (bits of the hash) per table, defaults to 12
+  # lsh_probes is the number of bits in which a bucket may differ from the query's and still be searched, defaults to 1
+  # disk_path is a directory for an out-of-core memory, defaults to None (all vectors are kept in RAM)
+  #     If given, environment and memory vectors are kept in memory-mapped files of block_rows vectors each
+  #     in disk_path (which is created if needed, and whose files are overwritten), and only the
+  #     block_rows most recently used environment vectors are kept in RAM as HRRs.
+  #     Updates to memory vectors are collected in a write buffer of buffer_rows vectors,
+  #     which is written to the files when it is full or before memory is read,
+  #     and requests compare the query to memory one block of memory vectors at a time.
+  #     Use save to keep a memory; the files in disk_path are scratch space.
+  #     A copy of the HDM (e.g., the copy ccm makes for each agent of a model class) is given
+  #     a new directory beside disk_path, so that copies never write over each other's files.
+  # block_rows is the number of vectors per file when disk_path is given, defaults to 4096
+  # buffer_rows is the size of the write buffer when disk_path is given, defaults to 1024
+  # workers is the number of threads that compare a query to memory, defaults to 1
+  #     If more than 1 (or None, for one per CPU), memory is split into shards of at least shard_rows vectors
+  #     that are compared to the query at the same time (numpy releases the GIL while it multiplies),
+  #     and the best match of each shard is merged into the best match in all of memory.
+  #     The threshold, inhibited values and finst are honoured exactly as with one thread,
+  #     and ties still go to the value added first.
+  #     close() stops the threads (they are started again if needed).
+  # shard_rows is the smallest shard, defaults to 16384
+  #     Memories with fewer than 2*shard_rows vectors are always compared on one thread.
   
-  def __init__(self,buffer,latency=0.05,threshold=-4.6,maximum_time=10.0,finst_size=4,finst_time=3.0, N=512, verbose=False, forgetting=1.0, noise=0.0):
+  def __init__(self,buffer,latency=0.05,threshold=-4.6,maximum_time=10.0,finst_size=4,finst_time=3.0, N=512, verbose=False, forgetting=1.0, noise=0.0, lazy_noise=False, retention=1.0, cache_size=1024, dtype=numpy.float64, accumulate_dtype=numpy.float64, seed=None, stats=False, lsh_tables=0, lsh_bits=12, lsh_probes=1, disk_path=None, block_rows=4096, buffer_rows=1024, workers=1, shard_rows=16384):
     Memory.__init__(self,buffer)
     self._buffer=buffer
     self.N = N
     self.verbose = verbose
-    self.env={'?': HRR(N=self.N)}
+    self.dtype = dtype
+    self.accumulate_dtype = accumulate_dtype
+    self.rng=RandomPool(seed) # random number generator with pregenerated blocks of draws
+    if disk_path is None:
+        self.env={'?': HRR(N=self.N,dtype=self.dtype,rng=self.rng)}
+        self.mem=MemoryStore(self.N,lazy_noise=lazy_noise,dtype=dtype,accumulate_dtype=accumulate_dtype,rng=self.rng,workers=workers,shard_rows=shard_rows)
+    else:
+        self.env=DiskVectors(disk_path,self.N,dtype=dtype,block_rows=block_rows,cache_size=block_rows)
+        self.env['?']=HRR(N=self.N,dtype=self.dtype,rng=self.rng)
+        self.mem=DiskMemoryStore(self.N,disk_path,block_rows=block_rows,buffer_rows=buffer_rows,lazy_noise=lazy_noise,dtype=dtype,accumulate_dtype=accumulate_dtype,rng=self.rng,workers=workers,shard_rows=shard_rows)
     self.placeholder = self.env['?']
-    self.mem={}
-    self.slots={')': numpy.random.permutation(self.N)}
+    if lsh_tables > 0:
+        # the hyperplanes come from a generator of their own,
+        # so that using an index does not change any other vectors drawn
+        planes=RandomPool((self.rng.initial_seed+1)%(2**31-1))
+        self.mem.setIndex(LSHIndex(self.N,lsh_tables,lsh_bits,lsh_probes,rng=planes))
+    self.slots={')': self.rng.permutation(self.N)}
     self.left=self.slots[')']
+    self.permuted={} # cache of environment vectors permuted by slot
+    # out of core, the cache is emptied when it holds block_rows values
+    self.permuted_size = None if disk_path is None else block_rows
+    self.ngrams=NgramCache(cache_size) # cache of open n-gram vectors
     self.error=False
     self.busy=False
     self.adaptors=[]
@@ -105,78 +224,184 @@ class HDM(Memory):
     self.finst=Finst(self,size=finst_size,time=finst_time)
     self._request_count=0
     self.inhibited=[] # list of inhibited values
+    self.templates={} # compiled chunks, by chunk string
     self.forgetting=forgetting
     self.noise=noise
+    if not 0 < retention <= 1:
+        raise Exception('retention must be greater than 0 and at most 1')
+    # rate of decay, in log units per second
+    self.decay_rate=-math.log(retention)
     self.lastUpdate = 0.0
+    self.stats=None
+    if stats:
+        self.stats=Stats()
+        self.stats.attach(self)
     
   def clear(self):
     self.mem.clear()
+
+  # stop the threads that compare queries to memory, if any
+  def close(self):
+    self.mem.close()
+
+  # start over with a new seed, as if this HDM had been made with seed=seed:
+  # memory is cleared and the placeholder '?', the permutation ')' and every other
+  # environment vector and slot permutation (in sorted order) are drawn again
+  # use this when an HDM is made before its seed is known, e.g., in the class of a model
+  def reseed(self,seed):
+    self.mem.clear()
+    self.rng.seed(seed)
+    self.env['?'] = HRR(N=self.N,dtype=self.dtype,rng=self.rng)
+    self.placeholder = self.env['?']
+    if self.mem.index is not None:
+        # new hyperplanes for the (now empty) index, also as in __init__
+        index = self.mem.index
+        planes = RandomPool((self.rng.initial_seed+1)%(2**31-1))
+        index.planes = numpy.array(planes.randn(index.tables*index.bits,self.N))
+    self.slots[')'] = self.rng.permutation(self.N)
+    self.left = self.slots[')']
+    for value in sorted(self.env.keys()):
+        if value != '?':
+            self.env[value] = HRR(N=self.N,dtype=self.dtype,rng=self.rng)
+    for slot in sorted(self.slots.keys()):
+        if slot != ')':
+            self.slots[slot] = self.rng.permutation(self.N)
+    self.permuted = {}
+    self.ngrams.clear()
     
+  @timed('add')
   def add(self,chunk,record=None,**keys):
     # if error flag is true, set to false for production system
     if self.error: self.error=False
     # add noise to memory
-    if (self.noise != 0):
+    if (self.noise != 0 or self.decay_rate != 0):
         self.addNoise()
-    # convert chunk to string (if it isn't already a string)
-    chunk = self.chunk2str(chunk)
-    # assign any unassigned values in chunk
-    chunk = self.assignValues(chunk)
+    # convert chunk to string, assign any unassigned values in chunk and split it into a list
+    chunk,chunkList = self.parseChunk(chunk)
     # check if chunk has slots by checking for colons (which separate slots from values)
     if ':' in chunk:
         # call addWithSlots to add a chunk with slot:value pairs to memory
-        self.addWithSlots(chunk)
+        self.addWithSlots(chunk,chunkList)
     else:
         # call addJustValues to add a chunk with values and no slots to memory
-        self.addJustValues(chunk)
+        self.addJustValues(chunk,chunkList)
+
 
+  # add many chunks to memory
+  # chunks can be any iterable of chunks, e.g., a generator reading a file (see read_chunks),
+  # and is consumed in blocks of block_size chunks
+  # same as calling add on each chunk in turn at the current time, but for each block
+  #   all new environment vectors are drawn at once,
+  #   chunks of the same length are encoded together,
+  #   and memory is updated with batched row additions
+  @timed('add_many')
+  def add_many(self,chunks,block_size=1024):
+    # if error flag is true, set to false for production system
+    if self.error: self.error=False
+    # add noise to memory
+    # (all chunks are added at the same time, so noise is only added once)
+    if (self.noise != 0 or self.decay_rate != 0):
+        self.addNoise()
+    block = []
+    blockLists = []
+    for chunk in chunks:
+        # convert chunk to string, assign any unassigned values in chunk and split it into a list
+        chunk,chunkList = self.parseChunk(chunk)
+        block.append(chunk)
+        blockLists.append(chunkList)
+        if len(block) == block_size:
+            self.addBlock(block,blockLists)
+            block = []
+            blockLists = []
+    if len(block) > 0:
+        self.addBlock(block,blockLists)
 
-  # function for adding noise over time to memory    
+  # add the chunks in the file called filename to memory, one chunk per line
+  # if delimiter is given, the file is read as a CSV file with one value
+  # (or slot:value pair) per field, otherwise values are separated by spaces
+  def add_file(self,filename,delimiter=None,block_size=1024):
+    self.add_many(read_chunks(filename,delimiter),block_size)
+
+  # add a block of chunk strings to memory
+  # chunkLists are the chunks as lists of values or of (slot,value) pairs, if already parsed
+  def addBlock(self,chunks,chunkLists=None):
+    # convert each chunk to a list of values or a list of (slot,value) pairs
+    if chunkLists is None:
+        chunkLists = [self.splitChunk(chunk) for chunk in chunks]
+    # define vectors for all the new values and slots in the block at once
+    self.defineVectors([attribute for chunkList in chunkLists for attribute in chunkList])
+    # use the cached chunk vectors of chunks that have been seen before
+    # and encode the other chunks of the same kind and length together
+    groups = {}
+    chunkVectors = [None] * len(chunkLists)
+    for c in range(len(chunkLists)):
+        cached = [self.ngrams.get(key) for key in self.leaveOneOutKeys(chunkLists[c])]
+        if None in cached:
+            withSlots = ':' in chunks[c]
+            groups.setdefault((withSlots,len(chunkLists[c])),[]).append(c)
+        else:
+            chunkVectors[c] = numpy.array([vector.v for vector in cached]).reshape(-1,self.N)
+    for (withSlots,numOfItems),members in groups.items():
+        if withSlots:
+            encoded = self.encodeLeaveOneOutWithSlots([chunkLists[c] for c in members])[0]
+        else:
+            encoded = self.encodeLeaveOneOut([chunkLists[c] for c in members])
+        for c,vectors in zip(members,encoded):
+            chunkVectors[c] = vectors
+            for key,vector in zip(self.leaveOneOutKeys(chunkLists[c]),vectors):
+                self.ngrams.put(key,HRR(data=vector))
+    # update memory with every value of every chunk, in order
+    values = []
+    for c in range(len(chunkLists)):
+        if ':' in chunks[c]:
+            values.extend([value for slot,value in chunkLists[c]])
+        else:
+            values.extend(chunkLists[c])
+    if len(values) > 0:
+        self.updateMemoryMany(values,numpy.concatenate(chunkVectors))
+
+
+  # function for adding noise (and decay) over time to memory    
+  @timed('addNoise')
   def addNoise(self):
     # weight by time difference
     diff = self.now() - self.lastUpdate
-    for value in self.mem.keys():
-        noiseVector = HRR(N=self.N)
-        self.mem[value] = self.mem[value] + (self.noise * diff * noiseVector)
+    # memory vector = e^(-decay rate * diff) * memory vector, for every memory vector
+    # (the noise added now has not decayed yet)
+    self.mem.decay(self.decay_rate * diff)
+    # memory vector = memory vector + noise * diff * noise vector, for every memory vector
+    self.mem.addNoise(self.noise * diff)
     self.lastUpdate = self.now()
         
 
-  def addWithSlots(self,chunk):
-    # convert chunk to a list of (slot,value) pairs
-    chunkList = self.chunk2list(chunk)
+  def addWithSlots(self,chunk,chunkList=None):
+    # convert chunk to a list of (slot,value) pairs (unless it has been already)
+    if chunkList is None:
+        chunkList = self.chunk2list(chunk)
     # define random Gaussian vectors and random permutations for any undefined values and slots
     self.defineVectors(chunkList)
+    # compute the chunk vectors for every position p in one pass,
+    # i.e., the vectors for chunkList with p's value replaced by ?
+    chunkVectors = self.getLeaveOneOutWithSlots(chunkList)
     # update the memory vectors with the information from the chunk
     for p in range(0,len(chunkList)):
-        # create a copy of chunkList
-        query = copy.deepcopy(chunkList)
-        # replace p's value with ? in query, but leave slot as is
-        query[p][1] = '?'
-        print chunkList[p][1]
-        print query
-        # compute chunk vector
-        chunkVector = self.getUOGwithSlots(query)
-        # update memory
-        self.updateMemory(chunkList[p][1],chunkVector)
+        self.updateMemory(chunkList[p][1],chunkVectors[p])
 
   # add a chunk to memory
   # when the chunk is just a list of values
   # without slots
-  def addJustValues(self,chunk):
-    # convert chunk to a list of values
-    chunkList = chunk.split()
+  def addJustValues(self,chunk,chunkList=None):
+    # convert chunk to a list of values (unless it has been already)
+    if chunkList is None:
+        chunkList = chunk.split()
     # define random Gaussian vectors for any undefined values
     self.defineVectors(chunkList)
+    # compute the chunk vectors for every position p in one pass,
+    # i.e., the vectors for chunkList with p replaced by ?
+    chunkVectors = self.getLeaveOneOut(chunkList)
     # update the memory vectors with the information from the chunk
     for p in range(0,len(chunkList)):
-        # create a copy of chunkList
-        query = copy.deepcopy(chunkList)
-        # replace p with ? in query
-        query[p] = '?'
-        # compute chunk vector
-        chunkVector = self.getUOG(query)
-        # update memory
-        self.updateMemory(chunkList[p],chunkVector)
+        self.updateMemory(chunkList[p],chunkVectors[p])
 
 
   # function for constructing a vector that represents chunkList
@@ -187,8 +412,8 @@ class HDM(Memory):
   # When slots are not used, the permutation "left" is used to preserve order
   def getUOG(self, chunkList):
     numOfItems = len(chunkList)
-    chunk = HRR(data=numpy.zeros(self.N))
-    sum   = HRR(data=numpy.zeros(self.N))
+    chunk = HRR(data=numpy.zeros(self.N,dtype=self.accumulate_dtype))
+    sum   = HRR(data=numpy.zeros(self.N,dtype=self.accumulate_dtype))
     p     = numOfItems # initially, this will be set to index of ? when ? is found
     for i in range (0,numOfItems):
         # get the vector for the value i
@@ -202,6 +427,10 @@ class HDM(Memory):
         # otherwise use the environment vector as is
         else:
             valVec = self.env[value]
+        # each convolution is a forward and an inverse FFT
+        if i > 0 and self.stats is not None:
+            self.stats.count('convolutions')
+            self.stats.count('ffts',2)
         # compute the chunk vector 
         if i == 0:
             sum = valVec
@@ -228,8 +457,8 @@ class HDM(Memory):
   # that include the ?
   def getUOGwithSlots(self, chunkList):
     numOfItems = len(chunkList)
-    chunk = HRR(data=numpy.zeros(self.N))
-    sum   = HRR(data=numpy.zeros(self.N))
+    chunk = HRR(data=numpy.zeros(self.N,dtype=self.accumulate_dtype))
+    sum   = HRR(data=numpy.zeros(self.N,dtype=self.accumulate_dtype))
     #sumStr = ''
     #chunkStr = ''
     p     = numOfItems # initially, this will be set to index of ? when ? is found
@@ -241,14 +470,17 @@ class HDM(Memory):
         # set p as the location of the placeholder ?
         if value == '?':
             p = i
+        # permute the environment vector by the slot
         # if value starts with ! then negate the environment vector
         if value.startswith('!'):
-            valVec = -1 * self.env[value[1:]]
+            valVec = -1 * self.getPermuted(value[1:],slot)
         # otherwise use the environment vector as is
         else:
-            valVec = self.env[value]
-        # permute the environment vector by the slot
-        valVec = valVec.permute(self.slots[slot])
+            valVec = self.getPermuted(value,slot)
+        # each convolution is a forward and an inverse FFT
+        if i > 0 and self.stats is not None:
+            self.stats.count('convolutions')
+            self.stats.count('ffts',2)
         #slotvalueStr = slot+':'+value
         # compute the chunk vector 
         if i == 0:
@@ -273,21 +505,172 @@ class HDM(Memory):
     return chunk #, chunkStr
 
 
+  # constructs, in one pass, the n vectors that getUOG would construct
+  # for chunkList with the value at p = 0 ... n-1 replaced by ?
+  # returns a list of HRRs, one for each position in chunkList
+  def getLeaveOneOut(self, chunkList):
+    keys = self.leaveOneOutKeys(chunkList)
+    vectors = [self.ngrams.get(key) for key in keys]
+    if None in vectors:
+        vectors = [HRR(data=row) for row in self.encodeLeaveOneOut([chunkList])[0]]
+        for key,vector in zip(keys,vectors):
+            self.ngrams.put(key,vector)
+    return vectors
+
+  # constructs, in one pass, the n vectors that getUOGwithSlots would construct
+  # for chunkList with the value at p = 0 ... n-1 replaced by ?
+  # returns a list of HRRs, one for each position in chunkList
+  def getLeaveOneOutWithSlots(self, chunkList):
+    keys = self.leaveOneOutKeys(chunkList)
+    vectors = [self.ngrams.get(key) for key in keys]
+    if None in vectors:
+        encoded,spectra = self.encodeLeaveOneOutWithSlots([chunkList])
+        vectors = [HRR(data=encoded[0,p]).cache_spectrum(spectra[0,p]) for p in range(len(chunkList))]
+        for key,vector in zip(keys,vectors):
+            self.ngrams.put(key,vector)
+    return vectors
+
+  # the key of the open n-gram vector for chunkList in the n-gram cache
+  # i.e., chunkList as a tuple of values or of (slot,value) pairs
+  def ngramKey(self,chunkList):
+    return tuple([tuple(attribute) if isinstance(attribute,list) else attribute for attribute in chunkList])
+
+  # the keys of the n vectors for chunkList with the value at p = 0 ... n-1 replaced by ?
+  def leaveOneOutKeys(self,chunkList):
+    keys = []
+    for p in range(len(chunkList)):
+        if isinstance(chunkList[p],list):
+            key = self.ngramKey(chunkList[:p]) + ((chunkList[p][0],'?'),) + self.ngramKey(chunkList[p+1:])
+        else:
+            key = self.ngramKey(chunkList[:p]) + ('?',) + self.ngramKey(chunkList[p+1:])
+        keys.append(key)
+    return keys
+
+  # get the environment vector for value,
+  # negated if value starts with ! and permuted by slot if a slot is given
+  def getValueVector(self,value,slot=None):
+    negate = value.startswith('!')
+    if negate:
+        value = value[1:]
+    if slot is None:
+        valVec = self.env[value]
+    else:
+        valVec = self.getPermuted(value,slot)
+    if negate:
+        valVec = -1 * valVec
+    return valVec
+
+  # leave-one-out encoding of a block of chunks without slots that all have n values
+  # The values before p are shared by all placeholders after them,
+  # so the open grams of the prefix are accumulated once, left to right.
+  # Every placeholder opened so far is one row of a matrix,
+  # and each new value extends all of those rows with one batched convolution.
+  # returns an array of shape (chunks, n, N) where [c,p] is the vector
+  # getUOG would construct for chunk c with the value at p replaced by ?
+  def encodeLeaveOneOut(self, chunkLists):
+    numOfChunks = len(chunkLists)
+    numOfItems  = len(chunkLists[0])
+    placeholder = self.env['?']
+    accumulate  = self.accumulate_dtype
+    chunk = numpy.zeros((numOfChunks,self.N),dtype=accumulate)
+    sum   = numpy.zeros((numOfChunks,self.N),dtype=accumulate)
+    # rows of open grams (plus the placeholder) that include ? at p, for each p < i
+    opened = numpy.zeros((numOfChunks,0,self.N),dtype=accumulate)
+    for i in range (0,numOfItems):
+        valVecs     = [self.getValueVector(chunkList[i]) for chunkList in chunkLists]
+        valVectors  = numpy.array([valVec.v for valVec in valVecs])
+        valSpectra  = numpy.array([valVec.spectrum() for valVec in valVecs])
+        if self.stats is not None and i > 0:
+            # one row FFT and two convolutions (one inverse FFT each) per chunk for the prefix,
+            # and a forward and an inverse FFT for each open gram that is extended
+            self.stats.count('convolutions',numOfChunks*(opened.shape[1]+2))
+            self.stats.count('ffts',numOfChunks*(2*opened.shape[1]+3))
+        # extend all open grams that include an earlier ? with value i
+        if opened.shape[1] > 0:
+            leftOperands = fft_real(opened[:,:,self.left],axis=2)
+            opened = opened + fft_inverse(leftOperands*valSpectra[:,numpy.newaxis,:],self.N,accumulate,axis=2)
+        # open the grams that include ? at i, and extend the prefix with value i
+        if i == 0:
+            opened = numpy.tile(placeholder.v.astype(accumulate),(numOfChunks,1,1))
+            sum    = valVectors.astype(accumulate)
+        else:
+            leftOperand = fft_real((chunk + sum)[:,self.left],axis=1)
+            bound  = fft_inverse(leftOperand*placeholder.spectrum(),self.N,accumulate,axis=1) + placeholder.v
+            opened = numpy.concatenate([opened,bound[:,numpy.newaxis,:]],axis=1)
+            chunk  = chunk + fft_inverse(leftOperand*valSpectra,self.N,accumulate,axis=1)
+            sum    = sum + valVectors
+    return opened - placeholder.v
+
+  # leave-one-out encoding of a block of chunks with slots that all have n slot:value pairs
+  # Without the left permutation, the open grams that include ? at p are
+  #     ?_p * ( (1 + v_0) * ... * (1 + v_n-1) without (1 + v_p) ) - ?_p
+  # where 1 is the identity vector for convolution, ?_p is the placeholder
+  # permuted by the slot at p, and v_i is value i permuted by its slot.
+  # In the Fourier domain this is a product of spectra,
+  # so every leave-one-out product comes from shared prefix and suffix products.
+  # returns (vectors,spectra), arrays of shape (chunks, n, N) and (chunks, n, N/2+1)
+  # where vectors[c,p] is the vector getUOGwithSlots would construct
+  # for chunk c with the value at p replaced by ?
+  def encodeLeaveOneOutWithSlots(self, chunkLists):
+    numOfChunks = len(chunkLists)
+    numOfItems  = len(chunkLists[0])
+    accumulate  = self.accumulate_dtype
+    if numOfItems == 0:
+        return numpy.zeros((numOfChunks,0,self.N),dtype=accumulate),numpy.zeros((numOfChunks,0,self.N//2+1),dtype=complex_dtype(accumulate))
+    values = numpy.array([[self.getValueVector(value,slot).spectrum() for slot,value in chunkList] for chunkList in chunkLists])
+    placeholders = numpy.array([[self.getPermuted('?',slot).spectrum() for slot,value in chunkList] for chunkList in chunkLists])
+    factors = (1 + values).astype(complex_dtype(accumulate))
+    ones    = numpy.ones((numOfChunks,1,factors.shape[2]),dtype=factors.dtype)
+    # prefix[c,p] is the product of the factors before p, suffix[c,p] of the factors after p
+    prefix  = numpy.concatenate([ones,numpy.cumprod(factors[:,:-1],axis=1)],axis=1)
+    suffix  = numpy.concatenate([numpy.cumprod(factors[:,:0:-1],axis=1)[:,::-1],ones],axis=1)
+    spectra = placeholders * (prefix * suffix - 1)
+    if self.stats is not None:
+        # one inverse FFT per leave-one-out vector (value spectra are cached)
+        self.stats.count('convolutions',numOfChunks*numOfItems)
+        self.stats.count('ffts',numOfChunks*numOfItems)
+    return fft_inverse(spectra,self.N,accumulate,axis=2),spectra
+
+
+  # get the environment vector for value permuted by slot
+  # permuted vectors are cached, along with their Fourier spectra,
+  # so that convolving with them costs no forward FFT.
+  # The cache for a value is cleared when set redefines its environment vector
+  def getPermuted(self,value,slot):
+    if self.permuted_size is not None and value not in self.permuted and len(self.permuted) >= self.permuted_size:
+        self.permuted.clear()
+    slots = self.permuted.setdefault(value,{})
+    if slot not in slots:
+        slots[slot] = self.env[value].permute(self.slots[slot])
+    return slots[slot]
+
+
   # for updating a memory vector for value with chunk
+  # memory vector = forgetting * memory vector + chunk
+  # (a value that is not yet in memory starts from a vector of zeros)
   def updateMemory(self,value,chunking):
     if value.startswith('!'):
-        if value[1:] not in self.mem:
-            self.mem[value[1:]] = -1*chunking
-        else:
-            self.mem[value[1:]] = self.forgetting * self.mem[value[1:]] - chunking
+        self.mem.update(value[1:],-1*chunking,self.forgetting)
     else:
-        if value not in self.mem:
-            self.mem[value] = chunking
+        self.mem.update(value,chunking,self.forgetting)
+
+
+  # for updating the memory vectors for a list of values with an array of chunk vectors
+  # same as calling updateMemory for each value and vector in turn
+  def updateMemoryMany(self,values,chunkings):
+    signs = numpy.ones(len(values))
+    names = []
+    for i in range(len(values)):
+        if values[i].startswith('!'):
+            signs[i] = -1
+            names.append(values[i][1:])
         else:
-            self.mem[value] = self.forgetting * self.mem[value] + chunking
+            names.append(values[i])
+    self.mem.updateMany(names,chunkings*signs[:,numpy.newaxis],self.forgetting)
 
 
   # default request function, call this
+  @timed('request')
   def request(self,chunk,require_new=False):
      self.busy=True
      if self.error: self.error=False
@@ -295,46 +678,46 @@ class HDM(Memory):
 
      
      # add noise to memory
-     if (self.noise != 0):
+     if (self.noise != 0 or self.decay_rate != 0):
         self.addNoise()
 
      # clear list of inhibited values from previous queries
      self.inhibited = []
-     # convert chunk to string (if it isn't already a string)
-     chunk = self.chunk2str(chunk)
-     # assign any unassigned values in chunk string and load inhibited values into self.inhibited
-     chunk = self.assignValues(chunk)
+     # convert chunk to string, assign any unassigned values in chunk string,
+     # load inhibited values into self.inhibited and split chunk into a list
+     chunk,chunkList = self.parseChunk(chunk)
      if '?' in chunk:
-        self.requestValue(chunk,require_new)
+        self.requestValue(chunk,require_new,chunkList)
      else:
-        self.resonance(chunk)
+        self.resonance(chunk,chunkList)
 
 
-  def requestValue(self,chunk,require_new=False):
+  def requestValue(self,chunk,require_new=False,chunkList=None):
      # check if chunk has slots by checking for colons (which separate slots from values)
      if ':' in chunk:
-        queryVec = self.queryWithSlots(chunk)
+        queryVec = self.queryWithSlots(chunk,chunkList)
      else:
-        queryVec = self.queryJustValues(chunk)
+        queryVec = self.queryJustValues(chunk,chunkList)
      
-     highestCosine = self.threshold
-     bestMatch = 'none'
      if self.verbose:
         print 'Query is: ' + chunk
         print 'inhibited values: ' + str(self.inhibited)
         print 'Finst contains: ' + str(self.finst.obj)
+     # skip inhibited values
+     # and skip previously reported values if require_new is true
+     exclude = list(self.inhibited)
+     if require_new:
+        exclude = exclude + self.finst.obj
      # find the best match to the query vector in memory
-     for mem,memVec in self.mem.items():
-        # skip inhibited values
-        if mem not in self.inhibited:
-            # skip previously reported values if require_new is true
-            if (not require_new) or (not self.finst.contains(mem)):
-                thisCosine = memVec.compare(queryVec)
-                if self.verbose:
-                    print mem, thisCosine
-                if thisCosine > highestCosine:
-                    highestCosine = thisCosine 
-                    bestMatch = mem
+     # all memory vectors are compared to the query in a single matrix product
+     bestMatch,highestCosine = self.mem.bestMatch(queryVec,exclude,self.threshold)
+     if self.verbose:
+        cosines = self.mem.cosines(queryVec)
+        for mem in self.mem.keys():
+            if mem not in exclude:
+                print mem, cosines[self.mem.rows[mem]]
+     if bestMatch is None:
+        bestMatch = 'none'
 
      if bestMatch == 'none':
         if self.verbose:
@@ -353,12 +736,12 @@ class HDM(Memory):
          self.recall(chunkObj,matches=[],request_number=self._request_count)
   
   # performs multiple queries to determine the "coherence" of the chunk
-  def resonance(self,chunk):
+  def resonance(self,chunk,chunkList=None):
      if '?' in chunk:
         print 'chunk is ' + chunk
         raise Exception("Use the resonance function when the chunk has no '?'. If there is a '?' use request instead")
           
-     coherence = self.get_activation(chunk)
+     coherence = self.coherence(chunk,chunkList)
      if self.verbose:
         print 'The coherence is ' + str(coherence)
      if coherence <= self.threshold:
@@ -372,74 +755,203 @@ class HDM(Memory):
   # called by resonance
   # called by request when no ? values are present
   # if logodds=True, the convert from mean cosine to logodds and return logodds
+  @timed('get_activation')
   def get_activation(self,chunk,logodds=False):
+     chunkList = None
      # if this function has been called directly, we need to convert
      if not self.busy:
-        # convert chunk to string (if it isn't already a string)
-        chunk = self.chunk2str(chunk)
-        # assign any unassigned values in chunk string and load inhibited values into self.inhibited
-        chunk = self.assignValues(chunk)
+        # convert chunk to string, assign any unassigned values in chunk string,
+        # load inhibited values into self.inhibited and split chunk into a list
+        chunk,chunkList = self.parseChunk(chunk)
         # add noise to memory
-        if (self.noise != 0):
+        if (self.noise != 0 or self.decay_rate != 0):
             self.addNoise()
 
-     # keep track of the number of occurrences of a particular value in case of repeats
-     occurrences = {}
-     # keep a running sum of the cosines and a count of the values in the chunk
-     sumOfCosines = 0;
-     numOfValues  = 0; 
-     # perform a query for each value in chunk
-     for slotvalue in chunk.split():
-        # create a query by removing the value and replacing it with '?'
-        query = chunk.split() # turn chunk into list
-        query.pop(numOfValues) # remove this list item
-        # check if chunk has slots by checking for colons (which separate slots from values)
-        if ':' in slotvalue:
-            slot,value = slotvalue.split(':')
-            query.insert(numOfValues, slot+':?') # replace value with ?
-            query = ' '.join(query) # convert query to a string
-            queryVec = self.queryWithSlots(query)
-        else:
-            value = slotvalue
-            query.insert(numOfValues, '?') # replace value with ?
-            query = ' '.join(query) # convert query to a string
-            queryVec = self.queryJustValues(query)
-        numOfValues = numOfValues + 1;
-
-        # find the match between the query vector and the value's memory vector
-        self.defineVectors([value])
-        match = self.mem[value].compare(queryVec)
-        sumOfCosines = sumOfCosines + match
-     coherence = sumOfCosines / numOfValues
+     coherence = self.coherence(chunk,chunkList)
      if logodds:
         return self.cosine_to_logodds(coherence)
      else:
         return coherence
 
+  # the coherence of a chunk string (chunkList is the chunk as a list, if already parsed)
+  def coherence(self,chunk,chunkList=None):
+     values,queryVecs = self.activationQueries(chunk,chunkList)
+     # find the match between each query vector and its value's memory vector
+     cosines = self.mem.compareMany(values,numpy.array([queryVec.v for queryVec in queryVecs]))
+     # the coherence is the mean of the cosines
+     return numpy.mean(cosines)
+
+  # builds the queries used to compute the coherence of a chunk
+  # returns the values in chunk and, for each value,
+  # the query vector for the chunk with that value replaced by '?'
+  # the chunk is parsed once and all the queries are built in one leave-one-out pass
+  # (they are the same vectors, and share the n-gram cache with, the queries
+  # queryWithSlots or queryJustValues would build for each position)
+  def activationQueries(self,chunk,chunkList=None):
+     if chunkList is None:
+        chunkList = self.splitChunk(chunk)
+     if ':' in chunk:
+        values = [value for slot,value in chunkList]
+        self.defineVectors(chunkList)
+        queryVecs = self.getLeaveOneOutWithSlots(chunkList)
+     else:
+        values = list(chunkList)
+        self.defineVectors(chunkList)
+        queryVecs = self.getLeaveOneOut(chunkList)
+     return values,queryVecs
+
+  # computes the coherence of many chunks
+  # all the queries of all the chunks are compared to memory in one batch
+  # returns an array with the coherence of each chunk
+  def coherences(self,chunks,chunkLists=None):
+     if chunkLists is None:
+        chunkLists = [None] * len(chunks)
+     values = []
+     queryVecs = []
+     counts = []
+     for chunk,chunkList in zip(chunks,chunkLists):
+        chunkValues,chunkQueries = self.activationQueries(chunk,chunkList)
+        values.extend(chunkValues)
+        queryVecs.extend(chunkQueries)
+        counts.append(len(chunkValues))
+     if len(values) == 0:
+        return numpy.zeros(len(counts))
+     cosines = self.mem.compareMany(values,numpy.array([queryVec.v for queryVec in queryVecs]))
+     counts = numpy.array(counts)
+     starts = numpy.cumsum(counts) - counts
+     return numpy.add.reduceat(cosines,starts) / counts
+
+  # computes the activation of many chunks at once,
+  # e.g., every probe of a list recall or fan effect experiment
+  # same as calling get_activation on each chunk in turn at the current time
+  # returns an array of mean cosines, or of log odds if logodds=True
+  @timed('get_activation_many')
+  def get_activation_many(self,chunks,logodds=False):
+     # add noise to memory (once, since all the chunks are evaluated at the same time)
+     if (self.noise != 0 or self.decay_rate != 0):
+        self.addNoise()
+     inhibited = self.inhibited
+     parsed = []
+     for chunk in chunks:
+        # parseChunk appends to self.inhibited, so give each chunk its own list
+        self.inhibited = []
+        parsed.append(self.parseChunk(chunk))
+     self.inhibited = inhibited
+     coherence = self.coherences([chunk for chunk,chunkList in parsed],[chunkList for chunk,chunkList in parsed])
+     if logodds:
+        return self.cosines_to_logodds(coherence)
+     else:
+        return coherence
+
+  # records the activations of probes (a list of chunks) every interval seconds of simulated time,
+  # for up to samples samples (the first one is taken after delay seconds, by default interval)
+  # must be called once the model is running, e.g., from init or a production
+  # returns the Recorder, see Recorder.export
+  def record(self,probes,interval=0.1,samples=1000,logodds=False,delay=None):
+     recorder = Recorder(self,probes,interval,samples,logodds)
+     recorder.start(delay)
+     return recorder
+
+  # scores many requests at once, e.g., every probe of an experiment
+  # each chunk is scored as request would score it,
+  # but nothing is placed in the buffer and the finst is not changed
+  # chunks with a '?' are compared to all of memory in blocks of matrix products,
+  # chunks without a '?' are scored by their coherence, as in resonance
+  # returns four arrays, with one entry per chunk:
+  #   matches: the best matching value (or, for resonance, the chunk), None if retrieval fails
+  #   cosines: the cosine of the best match (or the coherence), 0 if every value is excluded
+  #   activations: the cosines as log odds
+  #   latencies: the predicted reaction times (the time to fail if retrieval fails)
+  @timed('request_many')
+  def request_many(self,chunks,require_new=False):
+     # add noise to memory (once, since all the chunks are scored at the same time)
+     if (self.noise != 0 or self.decay_rate != 0):
+        self.addNoise()
+     inhibited = self.inhibited
+     probes = []
+     probeLists = []
+     valueProbes = []
+     queries = []
+     excludes = []
+     for chunk in chunks:
+        # each chunk has its own list of inhibited values
+        self.inhibited = []
+        chunk,chunkList = self.parseChunk(chunk)
+        if '?' in chunk:
+            if ':' in chunk:
+                queryVec = self.queryWithSlots(chunk,chunkList)
+            else:
+                queryVec = self.queryJustValues(chunk,chunkList)
+            exclude = list(self.inhibited)
+            if require_new:
+                exclude = exclude + self.finst.obj
+            valueProbes.append(len(probes))
+            queries.append(queryVec.v)
+            excludes.append(exclude)
+        probes.append(chunk)
+        probeLists.append(chunkList)
+     self.inhibited = inhibited
+
+     matches = numpy.empty(len(probes),dtype=object)
+     cosines = numpy.zeros(len(probes))
+     if len(valueProbes) > 0:
+        found,best = self.mem.bestMatches(numpy.array(queries),excludes,self.threshold)
+        matches[valueProbes] = found
+        # a query with no value left to compare to (e.g., every value is inhibited) fails,
+        # with a cosine of 0 and so an activation of -inf
+        cosines[valueProbes] = numpy.where(numpy.isneginf(best),0.0,best)
+     resonanceProbes = [c for c in range(len(probes)) if '?' not in probes[c]]
+     if len(resonanceProbes) > 0:
+        coherence = self.coherences([probes[c] for c in resonanceProbes],[probeLists[c] for c in resonanceProbes])
+        cosines[resonanceProbes] = coherence
+        for c,cosine in zip(resonanceProbes,coherence):
+            if cosine > self.threshold:
+                matches[c] = probes[c]
+     activations = self.cosines_to_logodds(cosines)
+     latencies = numpy.minimum(self.latency*numpy.exp(-activations),self.maximum_time)
+     # failed retrievals take as long as fail takes
+     if self.threshold is None:
+        failTime = self.maximum_time
+     else:
+        failTime = min(self.latency*math.exp(-self.cosine_to_logodds(self.threshold)),self.maximum_time)
+     latencies[numpy.equal(matches,None)] = failTime
+     return matches,cosines,activations,latencies
+
   # create a query vector for a chunk consisting of slot:value pairs
   # the query vector consists of the open n-grams of the slot:value pairs
   # only open n-grams that contain ? are included
   # the query vector must have one and only one query item "?"
-  def queryWithSlots(self,chunk):
-     # convert chunk to a list of (slot,value) pairs
-     chunkList = self.chunk2list(chunk)
+  def queryWithSlots(self,chunk,chunkList=None):
+     # convert chunk to a list of (slot,value) pairs (unless it has been already)
+     if chunkList is None:
+        chunkList = self.chunk2list(chunk)
      # define random Gaussian vectors and random permutations for any undefined values and slots
      self.defineVectors(chunkList)
-     # construct the query vector
-     queryVec = self.getUOGwithSlots(chunkList)
+     # construct the query vector, unless it is in the n-gram cache
+     key = self.ngramKey(chunkList)
+     queryVec = self.ngrams.get(key)
+     if queryVec is None:
+        queryVec = self.getUOGwithSlots(chunkList)
+        self.ngrams.put(key,queryVec)
      return queryVec
     
   # create a query vector for a chunk consisting of slot:value pairs
   # the query vector consists of the open n-grams of the values
   # only n-grams that contain ? are included
   # the query vector must have one and only one query item "?"
-  def queryJustValues(self,chunk):
-     # convert chunk to a list of values
-     chunkList = chunk.split()
+  def queryJustValues(self,chunk,chunkList=None):
+     # convert chunk to a list of values (unless it has been already)
+     if chunkList is None:
+        chunkList = chunk.split()
      # define random Gaussian vectors for any undefined values
      self.defineVectors(chunkList)
      # get all combinations ranging from pairs of slot-value pairs to sets
-     queryVec = self.getUOG(chunkList)
+     # unless the query vector is in the n-gram cache
+     key = self.ngramKey(chunkList)
+     queryVec = self.ngrams.get(key)
+     if queryVec is None:
+        queryVec = self.getUOG(chunkList)
+        self.ngrams.put(key,queryVec)
      return queryVec
 
   # chunk2str converts a chunk into a string
@@ -461,115 +973,198 @@ class HDM(Memory):
         raise Exception("Wrong chunk format!")
         return None
   
-  # assignValues checks for unassigned values, i.e., '?stuff'
-  # returns chunk as a string
-  def assignValues(self,chunk):
+  # splitChunk converts a chunk string into a list of (slot,value) pairs
+  # or, if it has no slots, a list of values
+  def splitChunk(self,chunk):
+    if ':' in chunk:
+        return self.chunk2list(chunk)
+    return chunk.split()
+
+  # compile converts a chunk string into a ChunkTemplate
+  # templates are kept, so each chunk (e.g., the pattern of a production) is only parsed once
+  def compile(self,chunk):
+    template = self.templates.get(chunk)
+    if template is None:
+        # keep the templates of at most 1024 chunks
+        if len(self.templates) >= 1024:
+            self.templates.clear()
+        template = ChunkTemplate(chunk)
+        self.templates[chunk] = template
+    return template
+
+  # parseChunk converts a chunk to a string, assigns its unassigned values (see assignValues)
+  # and splits it into a list (see splitChunk), using the compiled template of the chunk
+  # returns the chunk as a string and as a list
+  def parseChunk(self,chunk):
     # convert chunk to str (if it isn't already)
     chunk = self.chunk2str(chunk)
-    # replace instances of ?stuff with corresponding stuff
+    # the values of the variables bound by the production that is firing
     bound=None
     if hasattr(self,'sch'):
         bound=getattr(self.sch,'bound',None)
-    # split the chunkStr where there are spaces to get the list of attributes
-    attributes = chunk.split()
-    # find ?values that need to be substituted
-    chunkList = []
-    for attribute in attributes:
-        # this function needs to handle both chunks that are lists of slot:value pairs
-        # and chunks that are ordered lists of values
-        if ':' in attribute:
-            slot,value = attribute.split(':')
-            slot = slot + ':'
-        else:
-            value = attribute
-            slot  = '' 
-        # sometimes we want to specify things not to select
-        # for example, condiment:?unknown!mustard
-        # means find a condiment that isn't mustard
-        if value.startswith('?') and value is not '?':
-            first = True
-            for subvalue in value.split('!'):
-                # we know the first value starts with ?, so let's substitute
-                if first:
-                    first = False;
-                    #check to see if it's not just a ? by itself
-                    if subvalue is '?':
-                        value = '?'
-                    else:
-                        try:
-                            # take "?value" without the "?"
-                            key = subvalue[1:]
-                            # look it up in the "bound dictionary" and substitute
-                            value = bound[key]
-                        # if "value" in "?value" is undefined, replace with "?"
-                        except:
-                            value = '?'
-                # the following values all start with ! meaning things we don't want to retrieve
-                else:
-                    if subvalue.startswith('?'):
-                        # but some of them may start with ? indicating we need to substitute
-                        try:
-                            # take "?value" without the "?"
-                            key = subvalue[1:]
-                            # look it up in the "bound dictionary" and add to inhibited values list
-                            subvalue = bound[key]
-                        # if "value" in "?value" is undefined, raise exception
-                        except:
-                            print chunk
-                            print 'Error with subvalue: ' + subvalue + ' in chunk: ' + chunk
-                            raise Exception('Values beginning with ! are understood in this context as indicating values to be inhibited. The specified !value is undefined')
-                    # add subvalue to inhibition list
-                    self.inhibited.append(subvalue)
-
-        # add the value to the chunkList
-        chunkList.append(slot+value)
-    # convert chunkList into a string delimited by spaces
-    return ' '.join(chunkList)
+    return self.compile(chunk).fill(bound,self.inhibited)
+
+  # assignValues checks for unassigned values, i.e., '?stuff'
+  # replaces them with their bound values (or '?' if they are unbound)
+  # and adds values to be inhibited, i.e., '!stuff' or '!?stuff' following '?stuff', to self.inhibited
+  # returns chunk as a string
+  def assignValues(self,chunk):
+    return self.parseChunk(chunk)[0]
   
   
   #get environment vector for a given value
   def get(self,value):
     if value not in self.env:
-        self.env[value] = HRR(N=self.N)
-        self.mem[value] = HRR(data=numpy.zeros(self.N))
+        if self.stats is not None:
+            self.stats.count('env_vectors')
+        self.env[value] = HRR(N=self.N,dtype=self.dtype,rng=self.rng)
+        self.mem.addRow(value)
     return self.env[value].copy()
   
   
   #set environment vector for a given value to a specified vector
   def set(self,value,vector):
+    # environment vectors are convolved, so a SparseHRR is stored densely
+    if isinstance(vector,SparseHRR):
+        vector = vector.dense()
     try: # assume vector is an HRR object
-        newVec = vector.copy()
+        newVec = HRR(data=vector.v,dtype=self.dtype)
         newVec.normalize()
         self.env[value] = newVec
     except: # assume vector is a list of numbers
         vector = [float(i) for i in vector]
-        self.env[value] = HRR(data=vector)
-        self.env[value].normalize()
+        newVec = HRR(data=vector,dtype=self.dtype)
+        newVec.normalize()
+        self.env[value] = newVec
+    if value == '?':
+        self.placeholder = self.env['?']
+    # forget any permuted copies of the old environment vector
+    # and any open n-gram vectors built from it
+    self.permuted.pop(value,None)
+    self.ngrams.invalidate(value)
     # check to see if it's in memory already, if not, define its memory as a vector of zeros
-    if value not in self.mem:
-        self.mem[value] = HRR(data=numpy.zeros(self.N))
+    self.mem.addRow(value)
+
+
+  # save the state of HDM to the directory path, which is created if needed:
+  #   env.npy, mem.npy, norms.npy, noise.npy and slots.npy hold the environment vectors,
+  #   memory vectors, memory vector lengths, noise clocks and slot permutations as raw arrays
+  #   symbols.json holds the names of the rows of each array and the state of the clocks
+  def save(self,path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    names = list(self.env.keys())
+    # write the environment vectors one at a time, so they are never all copied at once
+    env = numpy.lib.format.open_memmap(os.path.join(path,'env.npy'),mode='w+',dtype=self.dtype,shape=(len(names),self.N))
+    for i in range(len(names)):
+        if isinstance(self.env,(MappedVectors,DiskVectors)):
+            env[i] = self.env.row(names[i])
+        else:
+            env[i] = self.env[names[i]].v
+    del env
+    # apply any decay still owed to memory vectors, so that every vector is saved as it is now
+    self.mem.applyDecay()
+    self.mem.renormalize()
+    n = len(self.mem)
+    # and the memory vectors a block at a time
+    mem = numpy.lib.format.open_memmap(os.path.join(path,'mem.npy'),mode='w+',dtype=self.mem.dtype,shape=(n,self.N))
+    for first,block in self.mem.blocks():
+        mem[first:first+len(block)] = block
+    del mem
+    numpy.save(os.path.join(path,'norms.npy'),self.mem.norms[:n])
+    numpy.save(os.path.join(path,'noise.npy'),self.mem.noiseClock[:n])
+    slots = list(self.slots.keys())
+    numpy.save(os.path.join(path,'slots.npy'),numpy.array([self.slots[slot] for slot in slots]))
+    symbols = {'N': self.N,
+               'dtype': numpy.dtype(self.dtype).name,
+               'env': names,
+               'mem': self.mem.keys(),
+               'slots': slots,
+               'lastUpdate': self.lastUpdate,
+               'noiseVariance': self.mem.noiseVariance}
+    f = open(os.path.join(path,'symbols.json'),'w')
+    try:
+        json.dump(symbols,f)
+    finally:
+        f.close()
+
+  # replace the state of HDM with the state saved in the directory path
+  # the vector arrays are memory-mapped (copy-on-write), not read into RAM:
+  # environment vectors are read when a value is first used
+  # and memory vectors are read as they are compared or updated.
+  # Changes are never written back to path; use save to keep them.
+  def load(self,path):
+    f = open(os.path.join(path,'symbols.json'),'r')
+    try:
+        symbols = json.load(f)
+    finally:
+        f.close()
+    # json gives back unicode strings: the values, slots and chunks of a model are str
+    for key in ['env','mem','slots']:
+        symbols[key] = [str(name) for name in symbols[key]]
+    self.N = symbols['N']
+    self.dtype = numpy.dtype(symbols['dtype']).type
+    self.env = MappedVectors(symbols['env'],numpy.load(os.path.join(path,'env.npy'),mmap_mode='c'))
+    self.placeholder = self.env['?']
+    slots = numpy.load(os.path.join(path,'slots.npy'))
+    self.slots = dict(zip(symbols['slots'],slots))
+    self.left = self.slots[')']
+    index = self.mem.index
+    if isinstance(self.mem,DiskMemoryStore):
+        # an out-of-core memory copies the saved memory vectors into its own files
+        self.mem.index = None
+        self.mem.clear()
+    else:
+        self.mem = MemoryStore(self.N,capacity=0,lazy_noise=self.mem.lazyNoise,dtype=self.dtype,accumulate_dtype=self.accumulate_dtype,rng=self.rng,workers=self.mem.workers,shard_rows=self.mem.shardRows)
+    self.mem.stats = self.stats
+    self.mem.restore(symbols['mem'],
+                     numpy.load(os.path.join(path,'mem.npy'),mmap_mode='c'),
+                     numpy.load(os.path.join(path,'norms.npy')),
+                     numpy.load(os.path.join(path,'noise.npy')),
+                     symbols['noiseVariance'])
+    # re-index the loaded memory vectors
+    if index is not None:
+        self.mem.setIndex(index)
+    self.lastUpdate = symbols['lastUpdate']
+    self.permuted = {}
+    self.ngrams.clear()
 
 
   # generate Gaussian vectors and random permutations for values & slots without
   # chunkList is a list of attributes, each attribute is a string
+  # the vectors for all new values are drawn at once
   def defineVectors(self,chunkList):
+    newValues = []
+    seen = set()
     for attribute in chunkList:
         # check to see if there is a slot, or if it's just a value without a slot
         if isinstance(attribute,list):
             slot,value = attribute
             # if it's a new slot, create a new random permutation
-            if slot not in self.slots.keys():
-                self.slots[slot] = numpy.random.permutation(self.N)
+            if slot not in self.slots:
+                self.slots[slot] = self.rng.permutation(self.N)
         else:
             value = attribute  
         # if it starts with ! (i.e., not) just ignore that for now
         if value.startswith('!'):
             value = value[1:]
         # if it's a new value, create a new random vector
-        if value not in self.env:
-            self.env[value] = HRR(N=self.N)
-            self.mem[value] = HRR(data=numpy.zeros(self.N))#self.env[value]
-  
+        if value not in self.env and value not in seen:
+            seen.add(value)
+            newValues.append(value)
+    if len(newValues) > 0:
+        vectors = self.newVectors(len(newValues))
+        for value,vector in zip(newValues,vectors):
+            self.env[value] = HRR(data=vector)
+            self.mem.addRow(value)
+
+  # draw k random Gaussian unit vectors, as rows of an array
+  def newVectors(self,k):
+    if self.stats is not None:
+        self.stats.count('env_vectors',k)
+    vectors = self.rng.randn(k,self.N)
+    vectors /= norm(vectors,axis=1)[:,numpy.newaxis]
+    return vectors.astype(self.dtype)
        
   def fail(self,request_number):
      if self.threshold is None: 
@@ -602,11 +1197,92 @@ class HDM(Memory):
             cosine = 0.999
         return math.log(cosine**2 / (1 - cosine**2))
 
+# Converts an array of cosines to log odds
+  def cosines_to_logodds(self,cosines):
+        cosines = numpy.minimum(cosines,0.999)
+        olderr = numpy.seterr(divide='ignore')
+        try:
+            return numpy.log(cosines**2 / (1 - cosines**2))
+        finally:
+            numpy.seterr(**olderr)
+
 # Converts log odds ratio or ACT-R activation
 # to a root probability (which the cosine approximates)
   def logodds_to_cosine(self,logodds):
         return math.sqrt(numpy.exp(logodds) / (numpy.exp(logodds) + 1))
 
+# ChunkTemplate is a chunk string parsed once, e.g., the pattern of a production's request
+# each attribute is compiled into its slot and either a value or the name of a variable (?name),
+# along with the values or variables it inhibits, e.g., condiment:?unknown!mustard!?other
+# so that assigning values when the production fires only looks up its bound variables,
+# without splitting or scanning strings.
+# A chunk without variables is split once and its string and list are reused as they are.
+class ChunkTemplate:
+  def __init__(self,chunk):
+    self.chunk=chunk
+    self.attributes=[] # (slot or None, value or None, variable or None, [(value or None, variable or None) to inhibit])
+    self.constant=True
+    for attribute in chunk.split():
+      # this function needs to handle both chunks that are lists of slot:value pairs
+      # and chunks that are ordered lists of values
+      if ':' in attribute:
+        slot,value=attribute.split(':')
+      else:
+        slot,value=None,attribute
+      variable=None
+      inhibits=[]
+      if value.startswith('?') and value!='?':
+        self.constant=False
+        subvalues=value.split('!')
+        if subvalues[0]=='?':
+          value='?'
+        else:
+          variable=subvalues[0][1:]
+          value=None
+        # the following values are things we don't want to retrieve, some of them variables
+        for subvalue in subvalues[1:]:
+          if subvalue.startswith('?'):
+            inhibits.append((None,subvalue[1:]))
+          else:
+            inhibits.append((subvalue,None))
+      self.attributes.append((slot,value,variable,inhibits))
+    if self.constant:
+      self.chunkList=self.split([value for slot,value,variable,inhibits in self.attributes])
+
+  # the chunk as a list of (slot,value) pairs, or of values if it has no slots, given a value for each attribute
+  def split(self,values):
+    if ':' in self.chunk:
+      return [[slot,value] if slot is not None else [value] for (slot,v,variable,inhibits),value in zip(self.attributes,values)]
+    return values
+
+  # fill in the values of the variables from bound (a dictionary)
+  # and append the values to inhibit to inhibited
+  # returns the chunk as a string and as a list (see HDM.splitChunk)
+  def fill(self,bound,inhibited):
+    if self.constant:
+      return self.chunk,list(self.chunkList)
+    values=[]
+    for slot,value,variable,inhibits in self.attributes:
+      if variable is not None:
+        # if the variable is unbound, replace it with '?'
+        try:
+          value=bound[variable]
+        except:
+          value='?'
+      for subvalue,name in inhibits:
+        if name is not None:
+          try:
+            subvalue=bound[name]
+          except:
+            print self.chunk
+            print 'Error with subvalue: ?' + name + ' in chunk: ' + self.chunk
+            raise Exception('Values beginning with ! are understood in this context as indicating values to be inhibited. The specified !value is undefined')
+        inhibited.append(subvalue)
+      values.append(value)
+    chunk=' '.join([slot+':'+value if slot is not None else value for (slot,v,variable,inhibits),value in zip(self.attributes,values)])
+    return chunk,self.split(values)
+
+
 class Finst:
   def __init__(self,parent,size=4,time=3.0):
     self.parent=parent
@@ -622,4 +1298,1082 @@ class Finst:
       self.remove(self.obj[0])
     self.parent.sch.add(self.remove,args=[o],delay=self.time)
   def remove(self,o):
-    if o in self.obj: self.obj.remove(o)
\ No newline at end of file
+    if o in self.obj: self.obj.remove(o)
+# read_chunks reads chunks from the file called filename, one chunk per line,
+# and yields each chunk as a string as it is read, so the file is never held in memory
+# blank lines are skipped
+# if delimiter is given, each line is read as CSV and the fields become space separated values
+def read_chunks(filename,delimiter=None):
+  f = open(filename,'r')
+  try:
+    if delimiter is None:
+      for line in f:
+        line = line.strip()
+        if line: yield line
+    else:
+      for fields in csv.reader(f,delimiter=delimiter):
+        fields = [field.strip() for field in fields if field.strip()]
+        if fields: yield ' '.join(fields)
+  finally:
+    f.close()
+
+
+# MappedVectors is a dictionary of HRRs backed by the rows of a matrix,
+# e.g., environment vectors memory-mapped by HDM.load.
+# The HRR for a value is only made from its row when the value is first used.
+class MappedVectors(dict):
+  def __init__(self,names,matrix):
+    dict.__init__(self)
+    self.matrix=matrix
+    self.index=dict([(names[i],i) for i in range(len(names))])
+  def __missing__(self,value):
+    vector=HRR(data=self.matrix[self.index[value]])
+    self[value]=vector
+    return vector
+  # the vector for value as an array, without making an HRR for it
+  def row(self,value):
+    if dict.__contains__(self,value):
+      return dict.__getitem__(self,value).v
+    return self.matrix[self.index[value]]
+  def __contains__(self,value):
+    return dict.__contains__(self,value) or value in self.index
+  def keys(self):
+    return list(self.index.keys())+[value for value in dict.keys(self) if value not in self.index]
+  def __iter__(self):
+    return iter(self.keys())
+  def __len__(self):
+    return len(self.keys())
+
+
+# MappedBlocks is a growable array of rows of N numbers kept on disk,
+# as files of block_rows rows each (e.g., mem0.npy, mem1.npy, ...) in the directory path.
+# Each file is memory-mapped, so only the pages in use are held in RAM,
+# and rows that have never been written take no space on disk (the files are sparse).
+# It is indexed like a 2-D array by a row, an array of rows or a slice of rows,
+# optionally followed by columns, e.g., blocks[rows], blocks[row,columns] or blocks[rows] = vectors
+# An array of rows is read or written with one fancy index per block it touches.
+class MappedBlocks:
+  def __init__(self,path,name,N,dtype=numpy.float64,block_rows=4096):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path=path
+    self.name=name
+    self.N=N
+    self.dtype=dtype
+    self.blockRows=block_rows
+    self.blocks=[] # one memory-mapped array per file
+
+  # the number of rows that fit in the files so far
+  def __len__(self):
+    return len(self.blocks)*self.blockRows
+
+  def filename(self,block):
+    return os.path.join(self.path,'%s%d.npy'%(self.name,block))
+
+  # add a file of zero rows
+  def grow(self):
+    filename=self.filename(len(self.blocks))
+    self.blocks.append(numpy.lib.format.open_memmap(filename,mode='w+',dtype=self.dtype,shape=(self.blockRows,self.N)))
+
+  # remove all the files
+  def clear(self):
+    for block in range(len(self.blocks)):
+      self.blocks[block]=None
+      os.remove(self.filename(block))
+    self.blocks=[]
+
+  # write changed pages back to the files
+  def flush(self):
+    for block in self.blocks:
+      block.flush()
+
+  # a copy gets files of its own, in a new directory beside path
+  # (the same one for every MappedBlocks in path copied together, e.g., the env and mem of an HDM)
+  def __deepcopy__(self,memo):
+    key=('MappedBlocks',self.path)
+    if key not in memo:
+      parent,name=os.path.split(os.path.abspath(self.path))
+      memo[key]=tempfile.mkdtemp(prefix=name+'-',dir=parent)
+    copied=MappedBlocks(memo[key],self.name,self.N,self.dtype,self.blockRows)
+    for block in self.blocks:
+      copied.grow()
+      copied.blocks[-1][:]=block
+    return copied
+
+  # split an index into rows (an integer or an array) and columns
+  def split(self,key):
+    if isinstance(key,tuple):
+      rows,columns=key
+    else:
+      rows,columns=key,slice(None)
+    if isinstance(rows,(int,long,numpy.integer)):
+      return int(rows),columns
+    if isinstance(rows,slice):
+      return numpy.arange(*rows.indices(len(self))),columns
+    return numpy.asarray(rows,dtype=int),columns
+
+  # for each block that rows fall in, the block and the positions in rows that fall in it
+  def byBlock(self,rows):
+    blocks=rows//self.blockRows
+    order=numpy.argsort(blocks,kind='mergesort')
+    blocks=blocks[order]
+    starts=numpy.flatnonzero(numpy.r_[True,blocks[1:]!=blocks[:-1]])
+    stops=numpy.r_[starts[1:],len(blocks)]
+    for start,stop in zip(starts,stops):
+      yield blocks[start],order[start:stop]
+
+  def __getitem__(self,key):
+    rows,columns=self.split(key)
+    if isinstance(rows,int):
+      block,row=divmod(rows,self.blockRows)
+      return self.blocks[block][row,columns]
+    width=len(numpy.arange(self.N)[columns])
+    result=numpy.empty((len(rows),width),dtype=self.dtype)
+    if len(rows)==0:
+      return result
+    for block,positions in self.byBlock(rows):
+      result[positions]=self.blocks[block][rows[positions]%self.blockRows][:,columns]
+    return result
+
+  def __setitem__(self,key,vectors):
+    rows,columns=self.split(key)
+    if isinstance(rows,int):
+      block,row=divmod(rows,self.blockRows)
+      self.blocks[block][row,columns]=vectors
+      return
+    if len(rows)==0:
+      return
+    vectors=numpy.asarray(vectors)
+    for block,positions in self.byBlock(rows):
+      local=rows[positions]%self.blockRows
+      part=vectors[positions] if vectors.ndim==2 else vectors
+      if isinstance(columns,slice) and columns==slice(None):
+        self.blocks[block][local]=part
+      else:
+        self.blocks[block][numpy.ix_(local,numpy.arange(self.N)[columns])]=part
+
+
+# DiskVectors holds environment vectors, by value, in MappedBlocks
+# it behaves like the dictionary of HRRs HDM keeps otherwise,
+# but only the cache_size most recently used vectors are kept as HRRs (with their spectra)
+class DiskVectors:
+  def __init__(self,path,N,dtype=numpy.float64,block_rows=4096,cache_size=4096):
+    self.matrix=MappedBlocks(path,'env',N,dtype,block_rows)
+    self.names=[]  # row index -> value
+    self.index={}  # value -> row index
+    self.cache=OrderedDict() # least recently used first
+    self.size=cache_size
+
+  def __getitem__(self,value):
+    vector=self.cache.pop(value,None)
+    if vector is None:
+      vector=HRR(data=self.matrix[self.index[value]])
+    self.remember(value,vector)
+    return vector
+
+  def __setitem__(self,value,vector):
+    row=self.index.get(value)
+    if row is None:
+      row=len(self.names)
+      if row==len(self.matrix):
+        self.matrix.grow()
+      self.index[value]=row
+      self.names.append(value)
+    self.matrix[row]=vector.v
+    self.cache.pop(value,None)
+    self.remember(value,vector)
+
+  def remember(self,value,vector):
+    if len(self.cache)>=self.size:
+      self.cache.popitem(last=False)
+    self.cache[value]=vector
+
+  # the vector for value as an array, without making an HRR for it
+  def row(self,value):
+    return self.matrix[self.index[value]]
+  def __contains__(self,value):
+    return value in self.index
+  def keys(self):
+    return list(self.names)
+  def __iter__(self):
+    return iter(self.keys())
+  def __len__(self):
+    return len(self.names)
+
+
+# NgramCache is a bounded LRU cache of open n-gram vectors
+# keyed by chunks with a placeholder, as tuples of values or of (slot,value) pairs.
+# For each value it remembers which keys use that value,
+# so that invalidate(value) drops exactly the vectors that depend on it.
+class NgramCache:
+  def __init__(self,size=1024):
+    self.size=size
+    self.vectors=OrderedDict() # least recently used first
+    self.dependencies={}       # value -> keys of the vectors that use value
+    self.hits=0
+    self.misses=0
+    self.stats=None            # Stats that also counts hits and misses, if any
+
+  def __len__(self):
+    return len(self.vectors)
+
+  # the values (without !) that the vector for key is built from
+  def valuesOf(self,key):
+    values=[]
+    for attribute in key:
+      value=attribute[1] if isinstance(attribute,tuple) else attribute
+      if value.startswith('!'): value=value[1:]
+      values.append(value)
+    return values
+
+  # returns the cached vector for key, or None
+  def get(self,key):
+    vector=self.vectors.pop(key,None)
+    if vector is None:
+      self.misses+=1
+      if self.stats is not None: self.stats.count('cache_misses')
+      return None
+    self.vectors[key]=vector
+    self.hits+=1
+    if self.stats is not None: self.stats.count('cache_hits')
+    return vector
+
+  def put(self,key,vector):
+    if self.size<=0: return
+    if key in self.vectors:
+      del self.vectors[key]
+    elif len(self.vectors)>=self.size:
+      self.remove(next(iter(self.vectors)))
+    self.vectors[key]=vector
+    for value in self.valuesOf(key):
+      self.dependencies.setdefault(value,set()).add(key)
+
+  def remove(self,key):
+    del self.vectors[key]
+    for value in self.valuesOf(key):
+      keys=self.dependencies.get(value)
+      if keys is not None:
+        keys.discard(key)
+        if len(keys)==0: del self.dependencies[value]
+
+  # drop every cached vector that uses value
+  def invalidate(self,value):
+    for key in list(self.dependencies.get(value,())):
+      self.remove(key)
+
+  def clear(self):
+    self.vectors.clear()
+    self.dependencies.clear()
+
+
+# Stats counts the work done by an HDM and times its main functions
+# counters are incremented by HDM, its MemoryStore and its NgramCache
+# (which only do so when they have a Stats object, so there is no cost when stats are off)
+# timers measure wall clock time, including the time of any timed function called from inside,
+# e.g., request includes the time of addNoise
+class Stats:
+  counterNames=['convolutions','ffts','compares','noise_draws','cache_hits','cache_misses','env_vectors','memory_rows']
+  timerNames=['add','add_many','request','request_many','get_activation','get_activation_many','addNoise']
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.counters=dict([(name,0) for name in Stats.counterNames])
+    self.calls=dict([(name,0) for name in Stats.timerNames])
+    self.seconds=dict([(name,0.0) for name in Stats.timerNames])
+
+  def count(self,name,k=1):
+    self.counters[name]+=k
+
+  # start counting and timing for hdm
+  # (the functions in timerNames are timed by the timed wrapper, whenever hdm.stats is set)
+  def attach(self,hdm):
+    hdm.stats=self
+    hdm.mem.stats=self
+    hdm.ngrams.stats=self
+
+  # add one call taking seconds to the timer called name
+  def addTime(self,name,seconds):
+    self.calls[name]+=1
+    self.seconds[name]+=seconds
+
+  # the counters and timers as a dictionary
+  def snapshot(self):
+    timers=dict([(name,{'calls':self.calls[name],'seconds':self.seconds[name]}) for name in Stats.timerNames])
+    return {'counters':dict(self.counters),'timers':timers}
+
+  # append a snapshot to filename as one line of JSON, e.g., once per simulation
+  # any keyword arguments (e.g., subject=3) are stored with the snapshot
+  def dump(self,filename,**labels):
+    record=self.snapshot()
+    record.update(labels)
+    f=open(filename,'a')
+    f.write(json.dumps(record,sort_keys=True)+'\n')
+    f.close()
+
+
+# Recorder samples the activations of a fixed set of probe chunks at regular intervals
+# each sample is an event in the HDM's scheduler that computes the activations of all the probes
+# in one batch (get_activation_many) and schedules the next sample,
+# so the model runs without being stopped and restarted between samples.
+# The times and activations are kept in arrays allocated for all the samples up front,
+# and written out at once by export.
+class Recorder:
+  def __init__(self,hdm,probes,interval=0.1,samples=1000,logodds=False):
+    self.hdm=hdm
+    self.probes=[hdm.chunk2str(probe) for probe in probes]
+    self.interval=interval
+    self.logodds=logodds
+    self.times=numpy.zeros(samples)
+    self.activations=numpy.zeros((samples,len(self.probes)))
+    self.count=0 # number of samples taken
+    self.running=False
+    self.pending=False # is a sample scheduled?
+
+  # start sampling, taking the next sample after delay seconds (by default interval)
+  def start(self,delay=None):
+    self.running=True
+    if not self.pending and self.count<len(self.times):
+      self.pending=True
+      if delay is None:
+        delay=self.interval
+      self.hdm.sch.add(self.sample,delay=delay)
+
+  # stop sampling (a sample that is already scheduled is skipped)
+  def stop(self):
+    self.running=False
+
+  def sample(self):
+    self.pending=False
+    if not self.running:
+      return
+    self.times[self.count]=self.hdm.now()
+    self.activations[self.count]=self.hdm.get_activation_many(self.probes,self.logodds)
+    self.count+=1
+    if self.count<len(self.times):
+      self.pending=True
+      self.hdm.sch.add(self.sample,delay=self.interval)
+    else:
+      self.running=False
+
+  # the samples taken so far, as an array of times and an array with one row of activations per time
+  def results(self):
+    return self.times[:self.count],self.activations[:self.count]
+
+  # write the samples taken so far to filename as CSV, one row per sample,
+  # with a header row: time followed by the probes
+  def export(self,filename,delimiter=','):
+    f=open(filename,'wb')
+    writer=csv.writer(f,delimiter=delimiter)
+    writer.writerow(['time']+self.probes)
+    times,activations=self.results()
+    writer.writerows(numpy.column_stack([times,activations]).tolist())
+    f.close()
+
+
+# LSHIndex is an approximate index of the rows of a MemoryStore (random-hyperplane LSH)
+# each of tables hash tables hashes a vector to the signs of its dot products with bits random hyperplanes,
+# so vectors with a small angle between them are likely to share a bucket in at least one table.
+# candidates(query) returns the rows in the query's bucket of each table,
+# and in every bucket whose hash differs from the query's in at most probes bits.
+# The index is updated incrementally: update(rows,vectors) moves just the rows that have changed bucket.
+class LSHIndex:
+  def __init__(self,N,tables=8,bits=12,probes=1,rng=None):
+    if rng is None: rng=RandomPool()
+    self.N=N
+    self.tables=tables
+    self.bits=bits
+    self.planes=numpy.array(rng.randn(tables*bits,N))
+    self.weights=2**numpy.arange(bits)
+    # all combinations of up to probes bits to flip, as masks of the hash
+    self.masks=[0]
+    for k in range(1,min(probes,bits)+1):
+      for flip in itertools.combinations(range(bits),k):
+        self.masks.append(sum([1<<b for b in flip]))
+    self.clear()
+
+  def clear(self):
+    self.codes=numpy.zeros((0,self.tables),dtype=numpy.int64) # row -> hash in each table (-1 if not indexed)
+    self.buckets=[{} for t in range(self.tables)]              # hash -> set of rows, for each table
+
+  # hashes of the rows of vectors, an array of shape (rows, tables)
+  def hash(self,vectors):
+    signs=numpy.dot(vectors,self.planes.T)>0
+    return numpy.dot(signs.reshape(len(vectors),self.tables,self.bits),self.weights)
+
+  # index rows, whose vectors are now the rows of vectors
+  def update(self,rows,vectors):
+    rows=numpy.asarray(rows)
+    if len(rows)==0: return
+    if rows.max()>=len(self.codes):
+      codes=-numpy.ones((max(2*len(self.codes),rows.max()+1),self.tables),dtype=numpy.int64)
+      codes[:len(self.codes)]=self.codes
+      self.codes=codes
+    new=self.hash(vectors)
+    old=self.codes[rows]
+    for t in range(self.tables):
+      buckets=self.buckets[t]
+      for i in numpy.flatnonzero(old[:,t]!=new[:,t]):
+        if old[i,t]>=0:
+          bucket=buckets[old[i,t]]
+          bucket.discard(rows[i])
+          if len(bucket)==0: del buckets[old[i,t]]
+        buckets.setdefault(new[i,t],set()).add(rows[i])
+    self.codes[rows]=new
+
+  # the candidate rows for query, in increasing order
+  def candidates(self,query):
+    code=self.hash(query[numpy.newaxis,:])[0]
+    rows=set()
+    for t in range(self.tables):
+      buckets=self.buckets[t]
+      for mask in self.masks:
+        bucket=buckets.get(code[t]^mask)
+        if bucket is not None: rows.update(bucket)
+    return numpy.array(sorted(rows),dtype=int)
+
+
+# MemoryStore holds the memory vectors of HDM
+# each value has one row in a single, preallocated 2-D array
+# and the norm of each row is cached, so that a retrieval
+# is one matrix-vector product over all of memory
+# rather than one HRR comparison per value.
+# MemoryStore behaves like a dictionary of HRRs,
+# i.e., memory[value] returns an HRR and memory[value] = vector sets a row
+# If lazy_noise is True, noise is not added to every row when addNoise is called.
+# Instead, the store keeps a running total of the noise variance added so far,
+# and each row remembers the total at the time it last received its noise.
+# The difference is drawn, in one batch, only for rows that are read or compared.
+# Rows are stored as dtype, while updates and row norms are computed as accumulate_dtype.
+# Decay is also applied lazily: the store keeps a decay clock, the total log decay so far,
+# and each row remembers the clock at the time it was last decayed.
+# A row is only scaled by the decay it owes when it is updated or read, or receives noise.
+# (The cosine of a row with a query does not depend on its scale, so scans do not decay rows.)
+# With lazy noise, the noise variance is kept in units of e^(-2 * decay clock),
+# so that the noise owed to a row includes the decay of that noise since it was added.
+# When the decay clock gets far from 0, it is reset to 0 and the row clocks are shifted to match (renormalize).
+# With more than one worker, scans of all of memory (bestMatches and cosines) are split into shards
+# of at least shard_rows rows, which a pool of workers threads compares to the queries at the same time.
+class MemoryStore:
+  def __init__(self,N,capacity=64,lazy_noise=False,dtype=numpy.float64,accumulate_dtype=numpy.float64,rng=None,workers=1,shard_rows=16384):
+    self.N=N
+    if workers is None:
+      workers=multiprocessing.cpu_count()
+    self.workers=workers
+    self.shardRows=shard_rows
+    self.pool=None # the threads, started when first needed
+    self.rng=rng if rng is not None else RandomPool()
+    self.stats=None # Stats that counts rows, noise draws and cosines, if any
+    self.index=None # approximate index of the rows (e.g., LSHIndex), if any
+    self.dtype=dtype
+    self.accumulate=accumulate_dtype
+    self.values=[] # row index -> value
+    self.rows={}   # value -> row index
+    self.vectors=numpy.zeros((capacity,N),dtype=dtype)
+    self.norms=numpy.zeros(capacity)
+    self.lazyNoise=lazy_noise
+    self.noiseVariance=0.0              # total variance of the noise added so far
+    self.noiseClock=numpy.zeros(capacity) # noiseVariance when each row last received its noise
+    self.decaying=False                 # has decay been called?
+    self.decayClock=0.0                 # total log decay so far (0 or less)
+    self.decayStamp=numpy.zeros(capacity) # decayClock when each row was last decayed
+
+  def __len__(self):
+    return len(self.values)
+  def __contains__(self,value):
+    return value in self.rows
+  def __iter__(self):
+    return iter(self.values)
+  def keys(self):
+    return list(self.values)
+  def items(self):
+    self.applyDecay()
+    self.applyNoise()
+    return [(value,self[value]) for value in self.values]
+  def __getitem__(self,value):
+    row=self.rows[value]
+    self.applyDecay([row])
+    self.applyNoise([row])
+    return HRR(data=self.vectors[row])
+  def __setitem__(self,value,vector):
+    row=self.addRow(value)
+    if isinstance(vector,SparseHRR):
+      vector=vector.dense()
+    self.vectors[row]=vector.v
+    self.norms[row]=self.rowNorms(self.vectors[row])
+    self.noiseClock[row]=self.noiseVariance
+    self.decayStamp[row]=self.decayClock
+    self.reindex([row])
+
+  def clear(self):
+    self.values=[]
+    self.rows={}
+    self.vectors[:]=0
+    self.norms[:]=0
+    self.noiseClock[:]=0
+    self.noiseVariance=0.0
+    self.decaying=False
+    self.decayClock=0.0
+    self.decayStamp[:]=0
+    if self.index is not None: self.index.clear()
+
+  # use index to find candidate rows for bestMatch and bestMatches
+  # (None to always compare to every row), the rows already stored are indexed
+  def setIndex(self,index):
+    self.index=index
+    if index is not None:
+      index.clear()
+      self.reindex(numpy.arange(len(self.values)))
+
+  # the rows of the store as (first row, array of rows) pairs, in order
+  # a MemoryStore holds all of its rows in one array, so there is only one block
+  def blocks(self):
+    n=len(self.values)
+    if n>0:
+      yield 0,self.vectors[:n]
+
+  # the blocks of rows, split into shards of about an equal share of memory per worker
+  # (but at least shard_rows rows each), as a list of (first row, array of rows) pairs, in order
+  def shards(self):
+    blocks=list(self.blocks())
+    n=len(self.values)
+    if self.workers<=1 or n<2*self.shardRows:
+      return blocks
+    size=max(self.shardRows,-(-n//self.workers))
+    shards=[]
+    for first,block in blocks:
+      for start in range(0,len(block),size):
+        shards.append((first+start,block[start:start+size]))
+    return shards
+
+  # function(shard) for each shard, in order, on the pool of workers if there is more than one shard
+  def scan(self,function,shards):
+    if self.workers<=1 or len(shards)<=1:
+      return [function(shard) for shard in shards]
+    if self.pool is None:
+      self.pool=ThreadPool(self.workers)
+    return self.pool.map(function,shards)
+
+  # stop the pool of workers, if it has been started
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool=None
+
+  # copies (e.g., of an HDM made in a model class) start threads of their own
+  def __getstate__(self):
+    state=self.__dict__.copy()
+    state['pool']=None
+    return state
+
+  # tell the index that rows have changed
+  def reindex(self,rows):
+    if self.index is not None and len(rows)>0:
+      self.index.update(rows,self.vectors[rows])
+
+  # returns the row index of value
+  # if value is new, a row of zeros is allocated for it
+  def addRow(self,value):
+    row=self.rows.get(value)
+    if row is None:
+      row=len(self.values)
+      if row==len(self.vectors):
+        self.grow()
+      if self.stats is not None: self.stats.count('memory_rows')
+      self.rows[value]=row
+      self.values.append(value)
+      # a new row owes no noise or decay from before it existed
+      self.noiseClock[row]=self.noiseVariance
+      self.decayStamp[row]=self.decayClock
+    return row
+
+  # use the arrays of a saved store (e.g., memory-mapped by HDM.load) as the rows of this store
+  # the rows are only copied into RAM if the store has to grow
+  def restore(self,values,vectors,norms,noiseClock,noiseVariance):
+    self.values=list(values)
+    self.rows=dict([(self.values[i],i) for i in range(len(self.values))])
+    self.vectors=vectors
+    self.norms=numpy.array(norms)
+    self.noiseClock=numpy.array(noiseClock)
+    self.noiseVariance=noiseVariance
+    # saved rows owe no decay (see HDM.save)
+    self.decaying=False
+    self.decayClock=0.0
+    self.decayStamp=numpy.zeros(len(self.noiseClock))
+    if self.index is not None: self.setIndex(self.index)
+
+  # double the capacity of the store
+  # so that adding k values costs O(k) copies in total
+  def grow(self):
+    capacity=max(2*len(self.vectors),1)
+    vectors=numpy.zeros((capacity,self.N),dtype=self.dtype)
+    vectors[:len(self.vectors)]=self.vectors
+    norms=numpy.zeros(capacity)
+    norms[:len(self.norms)]=self.norms
+    noiseClock=numpy.zeros(capacity)
+    noiseClock[:len(self.noiseClock)]=self.noiseClock
+    decayStamp=numpy.zeros(capacity)
+    decayStamp[:len(self.decayStamp)]=self.decayStamp
+    self.vectors=vectors
+    self.norms=norms
+    self.noiseClock=noiseClock
+    self.decayStamp=decayStamp
+
+  # add noise to every row:
+  # memory vector = memory vector + scale * noise vector
+  # where each noise vector is a random unit vector
+  def addNoise(self,scale):
+    if scale==0: return
+    n=len(self.values)
+    if self.lazyNoise:
+      self.noiseVariance+=scale**2*math.exp(-2*self.decayClock)
+      return
+    if self.stats is not None: self.stats.count('noise_draws',n)
+    # noise is added to the decayed rows
+    self.applyDecay()
+    for first,block in self.blocks():
+      noise=self.rng.randn(len(block),self.N)
+      noise*=scale/norm(noise,axis=1)[:,numpy.newaxis]
+      block+=noise
+      self.norms[first:first+len(block)]=self.rowNorms(block)
+    self.reindex(numpy.arange(n))
+
+  # draw the noise owed to rows (all rows if rows is None) since they last received noise
+  # the sum of k random unit vectors scaled by s_1 ... s_k is approximated by
+  # one Gaussian vector with variance (s_1^2 + ... + s_k^2) / N per element
+  # (with decay, each s_i^2 is scaled by the decay since it was added)
+  def applyNoise(self,rows=None):
+    if not self.lazyNoise: return
+    if rows is None:
+      rows=numpy.arange(len(self.values))
+    else:
+      rows=numpy.unique(rows)
+    pending=self.pendingNoise(rows)
+    rows=rows[pending>0]
+    if len(rows)==0: return
+    self.applyDecay(rows)
+    sd=numpy.sqrt(pending[pending>0]/self.N)
+    if self.stats is not None: self.stats.count('noise_draws',len(rows))
+    self.vectors[rows]+=self.rng.randn(len(rows),self.N)*sd[:,numpy.newaxis]
+    self.norms[rows]=self.rowNorms(self.vectors[rows])
+    self.noiseClock[rows]=self.noiseVariance
+    self.reindex(rows)
+
+  # the variance of the noise owed to rows since they last received noise
+  def pendingNoise(self,rows):
+    return (self.noiseVariance-self.noiseClock[rows])*math.exp(2*self.decayClock)
+
+  # advance the decay clock: every row decays by a factor of e^-amount
+  def decay(self,amount):
+    if amount<=0: return
+    self.decaying=True
+    self.decayClock-=amount
+    # keep e^(-2 * decay clock) well within floating point range
+    if self.decayClock<-50:
+      self.renormalize()
+
+  # reset the decay clock to 0, shifting the decay stamps and noise clocks of every row to match
+  # this only touches one number per row, the rows themselves are unchanged
+  def renormalize(self):
+    shift=self.decayClock
+    if shift==0: return
+    self.decayStamp-=shift
+    self.noiseVariance*=math.exp(2*shift)
+    self.noiseClock*=math.exp(2*shift)
+    self.decayClock=0.0
+
+  # the factor each of rows has decayed by since it was last decayed,
+  # the rows are then stamped as decayed (so the factors must be applied)
+  def decayFactors(self,rows):
+    factors=numpy.exp(self.decayClock-self.decayStamp[rows])
+    self.decayStamp[rows]=self.decayClock
+    return factors
+
+  # scale rows (all rows if rows is None) by the decay they owe since they were last decayed
+  def applyDecay(self,rows=None):
+    if not self.decaying: return
+    if rows is None:
+      for first,block in self.blocks():
+        last=first+len(block)
+        factors=self.decayFactors(numpy.arange(first,last))
+        block*=factors[:,numpy.newaxis]
+        self.norms[first:last]*=factors
+      return
+    rows=numpy.unique(rows)
+    factors=self.decayFactors(rows)
+    owing=factors<1
+    rows=rows[owing]
+    if len(rows)==0: return
+    self.vectors[rows]*=factors[owing][:,numpy.newaxis]
+    self.norms[rows]*=factors[owing]
+
+  # memory vector = forgetting * memory vector + vector
+  # vector can be an HRR or a SparseHRR, which is added to just the elements it has
+  def update(self,value,vector,forgetting=1.0):
+    row=self.addRow(value)
+    self.applyDecay([row])
+    self.applyNoise([row])
+    if isinstance(vector,SparseHRR):
+      self.updateSparse(row,vector,forgetting)
+      return
+    updated=self.vectors[row].astype(self.accumulate,copy=False)
+    if forgetting!=1.0:
+      updated*=forgetting
+    updated+=vector.v
+    self.vectors[row]=updated
+    self.norms[row]=norm(updated)
+    self.reindex([row])
+
+  # update with a SparseHRR: only the row's elements at vector.indices are read and written
+  # (unless forgetting scales the whole row), and the row norm is updated from them:
+  # |f*r + s|^2 = f^2 |r|^2 + 2 f <r,s> + |s|^2
+  def updateSparse(self,row,vector,forgetting=1.0):
+    if forgetting!=1.0:
+      self.vectors[row]*=forgetting
+    old=self.vectors[row,vector.indices].astype(self.accumulate)
+    squared=(forgetting*self.norms[row])**2+2*numpy.dot(old,vector.values)+numpy.dot(vector.values,vector.values)
+    self.vectors[row,vector.indices]=old+vector.values
+    self.norms[row]=numpy.sqrt(max(squared,0.0))
+    self.reindex([row])
+
+  # same as calling update for each value and row of vectors in turn:
+  # a row updated k times is scaled by forgetting^k, and each new vector
+  # by forgetting once for every later update to the same row
+  def updateMany(self,values,vectors,forgetting=1.0):
+    unique,factors,sums=self.group(values,vectors,forgetting)
+    self.applyDecay(unique)
+    self.applyNoise(unique)
+    updated=self.vectors[unique].astype(self.accumulate)*factors[:,numpy.newaxis]
+    updated+=sums
+    self.vectors[unique]=updated
+    self.norms[unique]=norm(updated,axis=1)
+    self.reindex(unique)
+
+  # groups the updates of updateMany by row
+  # returns the rows updated (in order), the factor each row is scaled by (forgetting^k for k updates)
+  # and, for each row, the sum of its new vectors, each scaled by forgetting once for every later update
+  def group(self,values,vectors,forgetting=1.0):
+    rows=numpy.array([self.addRow(value) for value in values])
+    order=numpy.argsort(rows,kind='mergesort')
+    rows=rows[order]
+    starts=numpy.flatnonzero(numpy.r_[True,rows[1:]!=rows[:-1]])
+    counts=numpy.diff(numpy.r_[starts,len(rows)])
+    later=numpy.repeat(starts+counts,counts)-1-numpy.arange(len(rows))
+    weighted=vectors[order].astype(self.accumulate)*(forgetting**later)[:,numpy.newaxis]
+    return rows[starts],forgetting**counts,numpy.add.reduceat(weighted,starts,axis=0)
+
+  # lengths of the rows of vectors (or of one vector), computed as the accumulate dtype
+  def rowNorms(self,vectors):
+    return numpy.sqrt(numpy.einsum('...i,...i->...',vectors,vectors,dtype=self.accumulate))
+
+  # cosine between the memory vector for value and an HRR
+  # values that have no memory vector have a cosine of 0
+  def compare(self,value,vector):
+    row=self.rows.get(value)
+    if row is None: return 0
+    if self.stats is not None: self.stats.count('compares')
+    self.applyNoise([row])
+    if isinstance(vector,SparseHRR):
+      scale=self.norms[row]*vector.length()
+      if scale==0: return 0
+      return numpy.dot(self.vectors[row,vector.indices],vector.values)/scale
+    scale=self.norms[row]*norm(vector.v)
+    if scale==0: return 0
+    return numpy.dot(self.vectors[row],vector.v)/scale
+
+  # cosines between the memory vectors for values and the rows of vectors, pairwise
+  # values that have no memory vector have a cosine of 0
+  def compareMany(self,values,vectors):
+    rows=numpy.array([self.rows.get(value,-1) for value in values],dtype=int)
+    known=numpy.flatnonzero(rows>=0)
+    if self.stats is not None: self.stats.count('compares',len(known))
+    self.applyNoise(rows[known])
+    dots=numpy.zeros(len(rows))
+    scale=numpy.zeros(len(rows))
+    dots[known]=numpy.einsum('ij,ij->i',self.vectors[rows[known]],vectors[known])
+    scale[known]=self.norms[rows[known]]*norm(vectors[known],axis=1)
+    nonzero=scale>0
+    return numpy.where(nonzero,dots/numpy.where(nonzero,scale,1),0.0)
+
+  # finds the best match in memory for each row of queries, skipping the values in excludes[i] for query i
+  # queries are scored block_size at a time, one matrix product per block of queries and block of memory
+  # returns a list of values (None where no cosine is above threshold)
+  # and an array of the best cosines (-inf where every value is excluded)
+  def bestMatches(self,queries,excludes,threshold=None,block_size=256):
+    n=len(self.values)
+    matches=[None]*len(queries)
+    best=numpy.empty(len(queries))
+    best.fill(-numpy.inf)
+    if n==0: return matches,best
+    # with an index, each query is only compared to its candidates
+    if self.index is not None:
+      for j in range(len(queries)):
+        row,best[j]=self.indexedMatch(queries[j],excludes[j])
+        if row is not None and (threshold is None or best[j]>threshold):
+          matches[j]=self.values[row]
+      return matches,best
+    self.applyNoise()
+    if self.stats is not None: self.stats.count('compares',n*len(queries))
+    queryNorms=norm(queries,axis=1)
+    excluded=[[self.rows[value] for value in exclude if value in self.rows] for exclude in excludes]
+    bestRows=numpy.zeros(len(queries),dtype=int)
+    shards=self.shards()
+    for start in range(0,len(queries),block_size):
+      stop=min(start+block_size,len(queries))
+      columns=numpy.arange(stop-start)
+      queryBlock=queries[start:stop].astype(self.dtype,copy=False).T
+      # the best row of a shard for each query, and its cosine
+      def score(shard):
+        first,block=shard
+        last=first+len(block)
+        scale=numpy.outer(self.norms[first:last],queryNorms[start:stop])
+        dots=numpy.dot(block,queryBlock)
+        nonzero=scale>0
+        cosines=numpy.where(nonzero,dots/numpy.where(nonzero,scale,1),0.0)
+        for j in range(start,stop):
+          for row in excluded[j]:
+            if first<=row<last: cosines[row-first,j-start]=-numpy.inf
+        rows=numpy.argmax(cosines,axis=0)
+        return cosines[rows,columns],rows+first
+      # keep the best row so far for each query, the first one in case of ties
+      for blockBest,rows in self.scan(score,shards):
+        better=blockBest>best[start:stop]
+        best[start:stop][better]=blockBest[better]
+        bestRows[start:stop][better]=rows[better]
+    for j in range(len(queries)):
+      if best[j]>-numpy.inf and (threshold is None or best[j]>threshold):
+        matches[j]=self.values[bestRows[j]]
+    return matches,best
+
+  # cosines between every memory vector and an HRR, in row order
+  # for a SparseHRR, only the columns at its indices are read
+  def cosines(self,vector):
+    self.applyNoise()
+    n=len(self.values)
+    if self.stats is not None: self.stats.count('compares',n)
+    sparse=isinstance(vector,SparseHRR)
+    if sparse:
+      length=vector.length()
+      values=vector.values.astype(self.dtype,copy=False)
+    else:
+      length=norm(vector.v)
+      values=vector.v.astype(self.dtype,copy=False)
+    cosines=numpy.zeros(n)
+    # each shard fills in its own rows
+    def score(shard):
+      first,block=shard
+      last=first+len(block)
+      scale=self.norms[first:last]*length
+      if sparse:
+        dots=numpy.dot(block[:,vector.indices],values)
+      else:
+        dots=numpy.dot(block,values)
+      nonzero=scale>0
+      cosines[first:last]=numpy.where(nonzero,dots/numpy.where(nonzero,scale,1),0.0)
+    self.scan(score,self.shards())
+    return cosines
+
+  # finds the value whose memory vector is most similar to vector
+  # skipping any values in exclude
+  # returns (value,cosine), or (None,threshold) if no cosine is above threshold
+  def bestMatch(self,vector,exclude=(),threshold=None):
+    if len(self.values)==0: return None,threshold
+    if self.index is not None:
+      if isinstance(vector,SparseHRR): vector=vector.dense()
+      row,cosine=self.indexedMatch(vector.v,exclude)
+      if row is None or (threshold is not None and cosine<=threshold):
+        return None,threshold
+      return self.values[row],cosine
+    cosines=self.cosines(vector)
+    for value in exclude:
+      row=self.rows.get(value)
+      if row is not None: cosines[row]=-numpy.inf
+    best=numpy.argmax(cosines)
+    if cosines[best]==-numpy.inf or (threshold is not None and cosines[best]<=threshold):
+      return None,threshold
+    return self.values[best],cosines[best]
+
+  # finds the best match for query (an array) among the candidate rows the index returns for it
+  # skipping any values in exclude
+  # the cosines of the candidates are exact, so only the search is approximate
+  # returns (row,cosine), or (None,-inf) if there are no candidates that are not excluded
+  def indexedMatch(self,query,exclude=()):
+    rows=self.index.candidates(query)
+    excluded=[self.rows[value] for value in exclude if value in self.rows]
+    if len(excluded)>0:
+      rows=rows[~numpy.in1d(rows,excluded)]
+    if len(rows)==0: return None,-numpy.inf
+    self.applyNoise(rows)
+    if self.stats is not None: self.stats.count('compares',len(rows))
+    scale=self.norms[rows]*norm(query)
+    dots=numpy.dot(self.vectors[rows],query.astype(self.dtype,copy=False))
+    nonzero=scale>0
+    cosines=numpy.where(nonzero,dots/numpy.where(nonzero,scale,1),0.0)
+    best=numpy.argmax(cosines)
+    return rows[best],cosines[best]
+
+
+# DiskMemoryStore is a MemoryStore for memories larger than RAM
+# The rows are kept on disk, in MappedBlocks of block_rows rows in the directory path,
+# and only the row norms and noise clocks (one number per row) are kept in RAM.
+# Updates are not written to the rows right away.
+# Instead, the write buffer keeps each updated row as: new row = scale * row + vector,
+# with later updates to the same row folded into scale and vector,
+# and it is written out, one block at a time, when it holds buffer_rows rows
+# or before any row is read or compared.
+# Retrieval scans memory one block at a time (see blocks),
+# so at most a block of rows is read, and a block of cosines computed, at once.
+class DiskMemoryStore(MemoryStore):
+  def __init__(self,N,path,block_rows=4096,buffer_rows=1024,lazy_noise=False,dtype=numpy.float64,accumulate_dtype=numpy.float64,rng=None,workers=1,shard_rows=16384):
+    MemoryStore.__init__(self,N,capacity=0,lazy_noise=lazy_noise,dtype=dtype,accumulate_dtype=accumulate_dtype,rng=rng,workers=workers,shard_rows=shard_rows)
+    self.vectors=MappedBlocks(path,'mem',N,dtype,block_rows)
+    self.bufferRows=buffer_rows
+    self.buffered={} # row -> position in the write buffer
+    self.bufferScales=numpy.ones(buffer_rows)
+    self.bufferVectors=numpy.zeros((buffer_rows,N),dtype=accumulate_dtype)
+
+  def __setitem__(self,value,vector):
+    self.flush()
+    MemoryStore.__setitem__(self,value,vector)
+
+  def clear(self):
+    self.buffered.clear()
+    self.vectors.clear()
+    self.values=[]
+    self.rows={}
+    self.norms=numpy.zeros(0)
+    self.noiseClock=numpy.zeros(0)
+    self.noiseVariance=0.0
+    self.decaying=False
+    self.decayClock=0.0
+    self.decayStamp=numpy.zeros(0)
+    if self.index is not None: self.index.clear()
+
+  # copy the arrays of a saved store into the blocks of this store, a block at a time
+  def restore(self,values,vectors,norms,noiseClock,noiseVariance):
+    self.clear()
+    self.values=list(values)
+    self.rows=dict([(self.values[i],i) for i in range(len(self.values))])
+    n=len(self.values)
+    while len(self.vectors)<n:
+      self.grow()
+    for start in range(0,n,self.vectors.blockRows):
+      stop=min(start+self.vectors.blockRows,n)
+      self.vectors[start:stop]=vectors[start:stop]
+    self.norms[:n]=norms
+    self.noiseClock[:n]=noiseClock
+    self.noiseVariance=noiseVariance
+    if self.index is not None: self.setIndex(self.index)
+
+  # add a block of rows
+  def grow(self):
+    self.vectors.grow()
+    extra=len(self.vectors)-len(self.norms)
+    self.norms=numpy.r_[self.norms,numpy.zeros(extra)]
+    self.noiseClock=numpy.r_[self.noiseClock,numpy.zeros(extra)]
+    self.decayStamp=numpy.r_[self.decayStamp,numpy.zeros(extra)]
+
+  # the rows, one block at a time (after writing out the write buffer)
+  def blocks(self):
+    self.flush()
+    n=len(self.values)
+    for block in range(len(self.vectors.blocks)):
+      first=block*self.vectors.blockRows
+      if first>=n: break
+      yield first,self.vectors.blocks[block][:min(n-first,self.vectors.blockRows)]
+
+  # rows are re-indexed a block at a time
+  def reindex(self,rows):
+    if self.index is None: return
+    for start in range(0,len(rows),self.vectors.blockRows):
+      MemoryStore.reindex(self,rows[start:start+self.vectors.blockRows])
+
+  # every read or comparison of rows applies their noise first, so the write buffer is written out here
+  def applyNoise(self,rows=None):
+    self.flush()
+    if not self.lazyNoise: return
+    if rows is None:
+      for start in range(0,len(self.values),self.vectors.blockRows):
+        MemoryStore.applyNoise(self,numpy.arange(start,min(start+self.vectors.blockRows,len(self.values))))
+    else:
+      MemoryStore.applyNoise(self,rows)
+
+  # the decay of a row is applied to it as it was before any update in the write buffer
+  def applyDecay(self,rows=None):
+    self.flush()
+    MemoryStore.applyDecay(self,rows)
+
+  # the candidates of the index are only up to date once the write buffer is written out
+  def indexedMatch(self,query,exclude=()):
+    self.flush()
+    return MemoryStore.indexedMatch(self,query,exclude)
+
+  # memory vector = forgetting * memory vector + vector, in the write buffer
+  def update(self,value,vector,forgetting=1.0):
+    row=self.addRow(value)
+    if isinstance(vector,SparseHRR):
+      vector=vector.dense()
+    rows=numpy.array([row])
+    # the row decays, and the noise owed to it is added, before it is scaled by forgetting, as in MemoryStore.update
+    decay=self.decayFactors(rows)
+    added=vector.v[numpy.newaxis,:]+forgetting*self.owedNoise(rows)
+    self.buffer(rows,forgetting*decay,added)
+
+  def updateMany(self,values,vectors,forgetting=1.0):
+    rows,factors,sums=self.group(values,vectors,forgetting)
+    decay=self.decayFactors(rows)
+    sums+=self.owedNoise(rows)*factors[:,numpy.newaxis]
+    self.buffer(rows,factors*decay,sums)
+
+  # with lazy noise, draw the noise owed to rows (an array of distinct rows, in order),
+  # as applyNoise would, without reading the rows
+  # returns an array with the noise for each row (zeros for rows that owe none)
+  def owedNoise(self,rows):
+    noise=numpy.zeros((len(rows),self.N),dtype=self.accumulate)
+    if not self.lazyNoise: return noise
+    pending=self.pendingNoise(rows)
+    owing=numpy.flatnonzero(pending>0)
+    if len(owing)==0: return noise
+    sd=numpy.sqrt(pending[owing]/self.N)
+    if self.stats is not None: self.stats.count('noise_draws',len(owing))
+    noise[owing]=self.rng.randn(len(owing),self.N)*sd[:,numpy.newaxis]
+    self.noiseClock[rows[owing]]=self.noiseVariance
+    return noise
+
+  # add updates to the write buffer: new row = scales[i] * row + vectors[i] for each of rows (all distinct)
+  # the buffer is written out first if the rows do not fit
+  def buffer(self,rows,scales,vectors):
+    for start in range(0,len(rows),self.bufferRows):
+      stop=start+self.bufferRows
+      positions=numpy.array([self.buffered.get(row,-1) for row in rows[start:stop]],dtype=int)
+      new=positions<0
+      if len(self.buffered)+numpy.count_nonzero(new)>self.bufferRows:
+        self.flush()
+        positions[:]=-1
+        new[:]=True
+      for i in numpy.flatnonzero(new):
+        positions[i]=len(self.buffered)
+        self.buffered[int(rows[start+i])]=positions[i]
+      self.bufferScales[positions[new]]=1.0
+      self.bufferVectors[positions[new]]=0.0
+      self.bufferScales[positions]*=scales[start:stop]
+      self.bufferVectors[positions]*=scales[start:stop,numpy.newaxis]
+      self.bufferVectors[positions]+=vectors[start:stop]
+
+  # write out the write buffer, in order of rows
+  def flush(self):
+    if len(self.buffered)==0: return
+    rows=numpy.array(list(self.buffered.keys()),dtype=int)
+    positions=numpy.array(list(self.buffered.values()),dtype=int)
+    order=numpy.argsort(rows)
+    rows=rows[order]
+    positions=positions[order]
+    self.buffered.clear()
+    updated=self.vectors[rows].astype(self.accumulate)
+    updated*=self.bufferScales[positions][:,numpy.newaxis]
+    updated+=self.bufferVectors[positions]
+    self.vectors[rows]=updated
+    self.norms[rows]=norm(updated,axis=1)
+    self.reindex(rows)
@@ -1,129 +1,399 @@
 import numpy
-from numpy.fft import fft,ifft
 from numpy.linalg import norm
+try:
+    from scipy.fft import rfft,irfft
+except ImportError:
+    from numpy.fft import rfft,irfft
 
 def set_random_seed(seed):
     numpy.random.seed(seed)
 
+def complex_dtype(dtype):
+    return numpy.result_type(dtype,numpy.complex64)
+
+def fft_real(v,axis=-1):
+    return rfft(v,axis=axis).astype(complex_dtype(v.dtype),copy=False)
+
+def fft_inverse(f,n,dtype,axis=-1):
+    if numpy.dtype(dtype).kind!='f': dtype=numpy.float64
+    return irfft(f,n,axis=axis).astype(dtype,copy=False)
+
+class RandomPool:
+    def __init__(self,seed=None,block=65536,perm_block=16):
+        if seed is None: seed=numpy.random.randint(0,2**31-1)
+        self.rng=numpy.random.RandomState()
+        self.block=block
+        self.perm_block=perm_block
+        self.seed(seed)
+    def seed(self,seed):
+        self.initial_seed=seed
+        self.rng.seed(seed)
+        self.normals=numpy.zeros(0)
+        self.used=0
+        self.perms=numpy.zeros((0,0),dtype=int)
+        self.perms_used=0
+    def refill(self,n):
+        rest=self.normals[self.used:]
+        self.normals=numpy.concatenate((rest,self.rng.standard_normal(max(self.block,n-len(rest)))))
+        self.used=0
+    def randn(self,*shape):
+        n=int(numpy.prod(shape))
+        if self.used+n>len(self.normals): self.refill(n)
+        r=self.normals[self.used:self.used+n].reshape(shape)
+        self.used+=n
+        return r
+    def permutation(self,n):
+        if self.perms.shape[1]!=n or self.perms_used==len(self.perms):
+            self.perms=numpy.argsort(self.rng.random_sample((self.perm_block,n)),axis=1)
+            self.perms_used=0
+        p=self.perms[self.perms_used]
+        self.perms_used+=1
+        return p
+    def random_sample(self,shape):
+        return self.rng.random_sample(shape)
+
 class HRR:
-    def __init__(self,N=None,data=None):
+    def __init__(self,N=None,data=None,dtype=None,rng=None):
+        self.spec=None
         if data is not None:
-            self.v=numpy.array(data)
+            self.v=numpy.array(data,dtype=dtype)
         elif N is not None:
-            self.randomize(N)
+            self.randomize(N,dtype,rng)
         else:
             raise Exception('Must specify size or data for HRR')
     def length(self):
         return norm(self.v)        
     def normalize(self):
         nrm=norm(self.v)
-        if nrm>0: self.v/=nrm
+        if nrm>0:
+            self.v/=nrm
+            self.spec=None
     def __str__(self):
         return str(self.v)
-    def randomize(self,N=None):
+    def randomize(self,N=None,dtype=None,rng=None):
         if N is None: N=len(self.v)
+        if dtype is None: dtype=self.v.dtype if hasattr(self,'v') else numpy.float64
+        if rng is None: rng=numpy.random
         sd=1.0/N
-        self.v=numpy.random.randn(N)*sd
+        self.v=(rng.randn(N)*sd).astype(dtype)
         self.normalize()
+    def spectrum(self):
+        if self.spec is None or self.spec[0] is not self.v:
+            self.spec=(self.v,fft_real(self.v))
+        return self.spec[1]
+    def cached_spectrum(self):
+        if self.spec is None or self.spec[0] is not self.v: return None
+        return self.spec[1]
+    def cache_spectrum(self,spectrum):
+        if spectrum is not None: self.spec=(self.v,spectrum)
+        return self
     def __add__(self,other):
-        return HRR(data=self.v+other.v)
+        if isinstance(other,(HRRArray,SparseHRR)): return other+self
+        a=self.cached_spectrum()
+        b=other.cached_spectrum()
+        r=HRR(data=self.v+other.v)
+        if a is not None and b is not None: r.cache_spectrum(a+b)
+        return r
     def __iadd__(self,other):
-        self.v+=other.v
+        if isinstance(other,SparseHRR): other.add_to(self.v)
+        else: self.v+=other.v
+        self.spec=None
         return self
     def __neg__(self):
-        return HRR(data=-self.v)    
+        a=self.cached_spectrum()
+        r=HRR(data=-self.v)
+        if a is not None: r.cache_spectrum(-a)
+        return r
     def __sub__(self,other):
-        return HRR(data=self.v-other.v)
+        if isinstance(other,(HRRArray,SparseHRR)): return (-other)+self
+        a=self.cached_spectrum()
+        b=other.cached_spectrum()
+        r=HRR(data=self.v-other.v)
+        if a is not None and b is not None: r.cache_spectrum(a-b)
+        return r
     def __isub__(self,other):
-        self.v-=other.v
+        if isinstance(other,SparseHRR): other.add_to(self.v,scale=-1.0)
+        else: self.v-=other.v
+        self.spec=None
         return self
     def __mul__(self,other):
+        if isinstance(other,(HRRArray,SparseHRR)): return other*self
         if isinstance(other,HRR):
-            x=ifft(fft(self.v)*fft(other.v)).real
-            x=x/norm(x)
-            return HRR(data=x)
+            f=self.spectrum()*other.spectrum()
+            x=fft_inverse(f,len(self.v),self.v.dtype)
+            nrm=norm(x)
+            return HRR(data=x/nrm).cache_spectrum(f/nrm)
         else:
-            return HRR(data=self.v*other)
+            a=self.cached_spectrum()
+            r=HRR(data=self.v*other)
+            if a is not None and numpy.isscalar(other): r.cache_spectrum(a*other)
+            return r
     def convolve(self,other):
-        x=ifft(fft(self.v)*fft(other.v)).real
-        return HRR(data=x)
+        if isinstance(other,HRRArray): return other.convolve(self)
+        if isinstance(other,SparseHRR): other=other.dense()
+        f=self.spectrum()*other.spectrum()
+        return HRR(data=fft_inverse(f,len(self.v),self.v.dtype)).cache_spectrum(f)
         
     def permute(self,permutation):
         permutedVector = self.v[permutation]
         return HRR(data=permutedVector)
         
     def __rmul__(self,other):
-        if isinstance(other,HRR):
-            x=ifft(fft(self.v)*fft(other.v)).real
-            x=x/norm(x)
-            return HRR(data=x)
-        else:
-            return HRR(data=self.v*other)
+        return self.__mul__(other)
     def __imul__(self,other):
-        self.v=ifft(fft(self.v)*fft(other.v))
+        if isinstance(other,SparseHRR): other=other.dense()
+        f=self.spectrum()*other.spectrum()
+        self.v=fft_inverse(f,len(self.v),self.v.dtype)
+        self.spec=(self.v,f)
         return self
     def compare(self,other):
+        if isinstance(other,(HRRArray,SparseHRR)): return other.compare(self)
         scale=norm(self.v)*norm(other.v)
         if scale==0: return 0
         return numpy.dot(self.v,other.v)/(scale)
     def dot(self,other):
+        if isinstance(other,SparseHRR): return other.dot(self)
         return numpy.dot(self.v,other.v)
     def distance(self,other):
         return 1-self.compare(other)
     def __invert__(self):
-        return HRR(data=self.v[numpy.r_[0,len(self.v)-1:0:-1]])
+        a=self.cached_spectrum()
+        r=HRR(data=self.v[numpy.r_[0,len(self.v)-1:0:-1]])
+        if a is not None: r.cache_spectrum(a.conj())
+        return r
     def __len__(self):
         return len(self.v)
     def copy(self):
-        return HRR(data=self.v)
+        return HRR(data=self.v).cache_spectrum(self.cached_spectrum())
     def mse(self,other):
         err=0
         for i in range(len(self.v)):
             err+=(self.v[i]-other.v[i])**2
         return err/len(self.v)
 
-    def sparcify_probability(self,prob):
-        r=numpy.random.random(self.v.shape)
-        while numpy.all(r>prob): r=numpy.random.random(self.v.shape)
+    def sparcify_probability(self,prob,rng=None):
+        if rng is None: rng=numpy.random
+        r=rng.random_sample(self.v.shape)
+        while numpy.all(r>prob): r=rng.random_sample(self.v.shape)
         self.v=numpy.where(r>prob,0,self.v)
     def sparcify_threshold(self,threshold):
         self.v=numpy.where(self.v<threshold,0,self.v)
+    def sparse(self):
+        return SparseHRR(hrr=self)
+
+class SparseHRR:
+    def __init__(self,N=None,indices=None,values=None,hrr=None):
+        if hrr is not None:
+            N=len(hrr.v)
+            indices=numpy.flatnonzero(hrr.v)
+            values=hrr.v[indices]
+        elif N is None:
+            raise Exception('Must specify size or HRR for SparseHRR')
+        if indices is None: indices=[]
+        if values is None: values=[]
+        indices=numpy.asarray(indices,dtype=int)
+        values=numpy.asarray(values,dtype=numpy.result_type(numpy.asarray(values).dtype,numpy.float32))
+        order=numpy.argsort(indices,kind='mergesort')
+        self.N=N
+        self.indices=indices[order]
+        self.values=values[order]
+    def __len__(self):
+        return self.N
+    def nnz(self):
+        return len(self.indices)
+    def dense(self):
+        v=numpy.zeros(self.N,dtype=self.values.dtype)
+        v[self.indices]=self.values
+        return HRR(data=v)
+    def length(self):
+        return norm(self.values)
+    def normalize(self):
+        nrm=norm(self.values)
+        if nrm>0: self.values=self.values/nrm
+    def __neg__(self):
+        return SparseHRR(self.N,self.indices,-self.values)
+    def __mul__(self,other):
+        if isinstance(other,(HRR,SparseHRR,HRRArray)): return self.dense()*other
+        return SparseHRR(self.N,self.indices,self.values*other)
+    def __rmul__(self,other):
+        return self.__mul__(other)
+    def __add__(self,other):
+        if isinstance(other,SparseHRR):
+            indices,inverse=numpy.unique(numpy.concatenate([self.indices,other.indices]),return_inverse=True)
+            values=numpy.zeros(len(indices),dtype=numpy.result_type(self.values,other.values))
+            numpy.add.at(values,inverse,numpy.concatenate([self.values,other.values]))
+            return SparseHRR(self.N,indices,values)
+        return HRR(data=self.add_to(other.v.copy()))
+    def __sub__(self,other):
+        return self+(-other)
+    def dot(self,other):
+        if isinstance(other,SparseHRR):
+            common,a,b=numpy.intersect1d(self.indices,other.indices,assume_unique=True,return_indices=True)
+            return numpy.dot(self.values[a],other.values[b])
+        return numpy.dot(self.values,other.v[self.indices])
+    def compare(self,other):
+        scale=self.length()*other.length()
+        if scale==0: return 0
+        return self.dot(other)/scale
+    def permute(self,permutation,inverse=None):
+        if inverse is None:
+            inverse=numpy.empty(len(permutation),dtype=int)
+            inverse[permutation]=numpy.arange(len(permutation))
+        return SparseHRR(self.N,inverse[self.indices],self.values)
+    def add_to(self,vectors,row=None,scale=1.0):
+        if row is None:
+            vectors[self.indices]+=scale*self.values
+        else:
+            vectors[row,self.indices]+=scale*self.values
+        return vectors
+
+class HRRArray:
+    def __init__(self,data=None,N=None,count=None,dtype=None,rng=None,copy=True):
+        self.spec=None
+        if data is not None:
+            if len(data)>0 and isinstance(data[0],HRR): data=[h.v for h in data]
+            self.v=numpy.array(data,dtype=dtype,ndmin=2,copy=copy)
+        elif N is not None and count is not None:
+            if rng is None: rng=numpy.random
+            if dtype is None: dtype=numpy.float64
+            self.v=(rng.randn(count,N)/N).astype(dtype)
+            self.normalize()
+        else:
+            raise Exception('Must specify size and count or data for HRRArray')
+    def __len__(self):
+        return len(self.v)
+    def __getitem__(self,i):
+        f=self.cached_spectrum()
+        if isinstance(i,(int,numpy.integer)):
+            r=HRR(data=self.v[i])
+        else:
+            r=HRRArray(data=self.v[i])
+        if f is not None: r.cache_spectrum(f[i])
+        return r
+    def hrrs(self):
+        return [self[i] for i in range(len(self))]
+    def spectrum(self):
+        if self.spec is None or self.spec[0] is not self.v:
+            self.spec=(self.v,fft_real(self.v,axis=1))
+        return self.spec[1]
+    def cached_spectrum(self):
+        if self.spec is None or self.spec[0] is not self.v: return None
+        return self.spec[1]
+    def cache_spectrum(self,spectrum):
+        if spectrum is not None: self.spec=(self.v,spectrum)
+        return self
+    def lengths(self):
+        return norm(self.v,axis=1)
+    def normalize(self):
+        nrm=self.lengths()
+        self.v=self.v/numpy.where(nrm>0,nrm,1)[:,numpy.newaxis]
+    def __add__(self,other):
+        a=self.cached_spectrum()
+        b=other.cached_spectrum()
+        r=HRRArray(data=self.v+other.v,copy=False)
+        if a is not None and b is not None: r.cache_spectrum(a+b)
+        return r
+    def __neg__(self):
+        a=self.cached_spectrum()
+        r=HRRArray(data=-self.v,copy=False)
+        if a is not None: r.cache_spectrum(-a)
+        return r
+    def __sub__(self,other):
+        return self+(-other)
+    def convolve(self,other):
+        f=self.spectrum()*other.spectrum()
+        return HRRArray(data=fft_inverse(f,self.v.shape[1],self.v.dtype,axis=1),copy=False).cache_spectrum(f)
+    def __mul__(self,other):
+        if isinstance(other,(HRR,HRRArray)):
+            r=self.convolve(other)
+            nrm=r.lengths()
+            nrm=numpy.where(nrm>0,nrm,1)[:,numpy.newaxis]
+            return HRRArray(data=r.v/nrm,copy=False).cache_spectrum(r.cached_spectrum()/nrm)
+        else:
+            a=self.cached_spectrum()
+            r=HRRArray(data=self.v*other,copy=False)
+            if a is not None and numpy.isscalar(other): r.cache_spectrum(a*other)
+            return r
+    def __rmul__(self,other):
+        return self.__mul__(other)
+    def permute(self,permutation):
+        permutation=numpy.asarray(permutation)
+        if permutation.ndim==1: return HRRArray(data=self.v[:,permutation],copy=False)
+        return HRRArray(data=numpy.take_along_axis(self.v,permutation,axis=1),copy=False)
+    def __invert__(self):
+        a=self.cached_spectrum()
+        r=HRRArray(data=self.v[:,numpy.r_[0,self.v.shape[1]-1:0:-1]],copy=False)
+        if a is not None: r.cache_spectrum(a.conj())
+        return r
+    def dot(self,other):
+        if isinstance(other,HRR): return numpy.dot(self.v,other.v.astype(self.v.dtype,copy=False))
+        return numpy.einsum('ij,ij->i',self.v,other.v)
+    def compare(self,other):
+        if isinstance(other,HRR):
+            scale=self.lengths()*norm(other.v)
+        else:
+            scale=self.lengths()*other.lengths()
+        dots=self.dot(other)
+        return numpy.where(scale>0,dots/numpy.where(scale>0,scale,1),0.0)
+    def compare_all(self,other):
+        if not isinstance(other,HRRArray): other=HRRArray(data=other)
+        scale=numpy.outer(self.lengths(),other.lengths())
+        dots=numpy.dot(self.v,other.v.astype(self.v.dtype,copy=False).T)
+        return numpy.where(scale>0,dots/numpy.where(scale>0,scale,1),0.0)
+    def copy(self):
+        return HRRArray(data=self.v).cache_spectrum(self.cached_spectrum())
 
 class Cleanup:
-    def __init__(self,limit=None):
+    def __init__(self,limit=None,capacity=16,dtype=None):
         self.vectors=None
         self.hrrs=None
         self.size=None
         self.count=0
         self.limit=limit
+        self.capacity=capacity
+        self.dtype=dtype
     def add(self,hrr):
         if self.vectors is None:
             self.size=len(hrr)
-            self.vectors=numpy.array([hrr.v])
-            self.hrrs=[hrr]
-        else:
-            if self.size!=len(hrr):
-                raise Exception('Added HRR of inconsistent size to cleanup memory')
-            self.hrrs.append(hrr)
-            self.vectors=numpy.append(self.vectors,[hrr.v],axis=0)
+            if self.dtype is None: self.dtype=hrr.v.dtype
+            self.vectors=numpy.zeros((self.capacity,self.size),dtype=self.dtype)
+            self.hrrs=[]
+        elif self.size!=len(hrr):
+            raise Exception('Added HRR of inconsistent size to cleanup memory')
+        if self.count==len(self.vectors):
+            vectors=numpy.zeros((2*len(self.vectors),self.size),dtype=self.dtype)
+            vectors[:self.count]=self.vectors
+            self.vectors=vectors
+        nrm=norm(hrr.v)
+        if nrm>0: self.vectors[self.count]=hrr.v/nrm
+        self.hrrs.append(hrr)
         self.count+=1
-    def clean(self,hrr):
-        if len(self.vectors)==0:
+    def compare(self,hrr):
+        nrm=norm(hrr.v)
+        if nrm==0: return numpy.zeros(self.count)
+        return HRRArray(data=self.vectors[:self.count],copy=False).dot(hrr)/nrm
+    def masked(self,hrr):
+        if self.count==0:
             raise Exception('No vectors in cleanup memory')
-        best=None
-        best_v=None
-        for v in self.hrrs:
-            c=hrr.compare(v)
-            if self.limit is not None and c<self.limit: continue
-            if best is None or c>best:
-                best=c
-                best_v=v
-        return best_v
+        c=self.compare(hrr)
+        if self.limit is not None:
+            c=numpy.where(c<self.limit,-numpy.inf,c)
+        return c
+    def clean(self,hrr):
+        c=self.masked(hrr)
+        best=numpy.argmax(c)
+        if c[best]==-numpy.inf: return None
+        return self.hrrs[best]
     def all(self,hrr):
-        r=[]
-        for h in self.hrrs:
-            r.append((hrr.compare(h),h))
-        return r
+        c=self.compare(hrr)
+        return [(c[i],h) for i,h in enumerate(self.hrrs)]
+    def top(self,hrr,k):
+        c=self.masked(hrr)
+        k=min(k,self.count)
+        if k<1: return []
+        best=numpy.argpartition(-c,k-1)[:k]
+        best=best[numpy.argsort(-c[best],kind='mergesort')]
+        return [(c[i],self.hrrs[i]) for i in best if c[i]!=-numpy.inf]
 
 
 class Mapper:
@@ -149,44 +419,106 @@ class Mapper:
         
                        
                        
-from math import sin,pi,acos
+from math import sin,pi,acos,log
+
+cleanup_tables={}
+def cleanup_table(dimensions,steps):
+    key=(dimensions,steps)
+    if key not in cleanup_tables:
+        angles=numpy.linspace(0,pi,steps+1)
+        logf=numpy.zeros(steps+1)
+        if dimensions>2:
+            with numpy.errstate(divide='ignore'):
+                logf=(dimensions-2)*numpy.log(numpy.sin(angles))
+            logf[-1]=-numpy.inf
+        segments=numpy.logaddexp(logf[:-1],logf[1:])+log(pi/steps/2)
+        cleanup_tables[key]=(angles[1:],numpy.logaddexp.accumulate(segments))
+    return cleanup_tables[key]
+
 class Vocabulary:
-    def __init__(self,dimensions,randomize=True):
+    def __init__(self,dimensions,randomize=True,dtype=numpy.float64,seed=None):
         self.dimensions=dimensions
         self.randomize=randomize
+        self.dtype=dtype
+        self.rng=RandomPool(seed)
         self.hrr={}
         ident=[0]*dimensions
         ident[0]=1.0
-        self.hrr['I']=HRR(data=ident)
+        self.hrr['I']=HRR(data=ident,dtype=dtype)
+        self.clear_atoms()
     def __getitem__(self,key):
         if key not in self.hrr:
             if self.randomize:    
-                self.hrr[key]=HRR(self.dimensions)
+                self.hrr[key]=HRR(self.dimensions,dtype=self.dtype,rng=self.rng)
             else:
                 v=[0]*self.dimensions
                 v[len(self.hrr)]=1.0
-                self.hrr[key]=HRR(data=v)    
+                self.hrr[key]=HRR(data=v,dtype=self.dtype)    
         return self.hrr[key]        
     def parse(self,text):
         return eval(text,{},self)
         
-    def text(self,v):
+    def clear_atoms(self):
+        self.names=[]
+        self.indexed=[]
+        self.units=numpy.zeros((0,self.dimensions))
+        self.spectra=numpy.zeros((0,self.dimensions//2+1),dtype=complex)
+        self.pair_norms=numpy.zeros((0,0))
+    def update_atoms(self):
+        for (hrr,v),k in zip(self.indexed,self.names):
+            if self.hrr.get(k) is not hrr or hrr.v is not v:
+                self.clear_atoms()
+                break
+        if len(self.hrr)-1==len(self.names): return
+        known=set(self.names)
+        new=[k for k in sorted(self.hrr.keys()) if k!='I' and k not in known]
+        hrrs=[self.hrr[k] for k in new]
+        atoms=HRRArray(data=hrrs,dtype=float)
+        spectra=atoms.spectrum()
+        atoms.normalize()
+        units=atoms.v
+        power=abs(spectra)**2
+        allPower=numpy.concatenate([abs(self.spectra)**2,power])
+        n=len(self.names)
+        pair_norms=numpy.zeros((n+len(new),n+len(new)))
+        pair_norms[:n,:n]=self.pair_norms
+        pair_norms[n:]=numpy.dot(power*self.weights(),allPower.T)
+        pair_norms[:,n:]=pair_norms[n:].T
+        self.names.extend(new)
+        self.indexed.extend([(h,h.v) for h in hrrs])
+        self.units=numpy.concatenate([self.units,units])
+        self.spectra=numpy.concatenate([self.spectra,spectra])
+        self.pair_norms=pair_norms
+    def weights(self):
+        w=numpy.ones(self.dimensions//2+1)*2.0/self.dimensions
+        w[0]/=2
+        if self.dimensions%2==0: w[-1]/=2
+        return w
+    def text(self,v,block_size=256):
+        self.update_atoms()
+        n=len(self.names)
+        x=numpy.asarray(v.v,dtype=float)
+        nx=norm(x)
+        if n==0 or nx==0: return ''
         matches=[]
-        
-        names=self.hrr.keys()
-        names.sort()
-        names.remove('I')
-
-        for i in range(len(names)):        
-            k=names[i]
-            val=self.hrr[k]
-            c=val.compare(v)
-            if c>0: matches.append((c,k))
-            for j in range(i+1,len(names)):
-                k2=names[j]
-                val2=self.hrr[k2]
-                c=(val*val2).compare(v)                
-                if c>0: matches.append((c,'%s*%s'%(k,k2)))
+        c=numpy.dot(self.units,x)/nx
+        for i in set(numpy.argsort(-c)[:2].tolist()+numpy.flatnonzero(c>0.3).tolist()):
+            if c[i]>0: matches.append((c[i],self.names[i]))
+        query=fft_real(x).conj()*self.weights()
+        columns=numpy.arange(n)
+        for start in range(0,n,block_size):
+            stop=min(start+block_size,n)
+            a=self.spectra[start:stop]*query
+            dots=numpy.dot(a.real,self.spectra.real.T)-numpy.dot(a.imag,self.spectra.imag.T)
+            scale=numpy.sqrt(self.pair_norms[start:stop])*nx
+            c=numpy.where(scale>0,dots/numpy.where(scale>0,scale,1),0.0)
+            c[columns[numpy.newaxis,:]<=columns[start:stop,numpy.newaxis]]=-numpy.inf
+            c=c.ravel()
+            best=numpy.argpartition(-c,min(1,len(c)-1))[:2]
+            for f in set(best.tolist()+numpy.flatnonzero(c>0.3).tolist()):
+                if c[f]>0:
+                    k,k2=sorted([self.names[start+f//n],self.names[f%n]])
+                    matches.append((c[f],'%s*%s'%(k,k2)))
         matches.sort()
         matches.reverse()
         r=[]
@@ -202,20 +534,19 @@ class Vocabulary:
         # see http://yamlb.wordpress.com/2008/05/20/why-2-random-vectors-are-orthogonal-in-high-dimention/ 
         #  for argument that the probability af two random vectors being a given angle apart is
         #  proportional to sin(angle)^(D-2)
-        def prob_func(angle): 
-            return sin(angle)**(self.dimensions-2)
-        angle=acos(compare)
-        num=0
-        dnum=angle/steps
-        denom=0
-        ddenom=pi/steps
-        for i in range(steps):
-            num+=prob_func(pi-angle+dnum*i)
-            denom+=prob_func(ddenom*i)
-        num*=dnum
-        denom*=ddenom    
-        perror1=num/denom    
-        pcorrect=(1-perror1)**vocab_size
+        # the integrals of sin(angle)^(D-2) are tabulated once per D as logs, so large D does not underflow;
+        #  compare and vocab_size can be arrays
+        angles,logcumulative=cleanup_table(self.dimensions,steps)
+        angle=numpy.arccos(numpy.clip(compare,-1,1))
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            # below the first step the integral is ~angle^(D-1)/(D-1)
+            lognum=numpy.where(angle<angles[0],
+                               logcumulative[0]+(self.dimensions-1)*numpy.log(angle/angles[0]),
+                               numpy.interp(angle,angles,logcumulative))
+            perror1=numpy.exp(lognum-logcumulative[-1])
+            pcorrect=numpy.exp(numpy.multiply(vocab_size,numpy.log1p(-perror1)))
+        pcorrect=numpy.where(numpy.equal(vocab_size,0),1.0,pcorrect)
+        if numpy.ndim(pcorrect)==0: return float(pcorrect)
         return pcorrect
         
         
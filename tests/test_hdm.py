@@ -0,0 +1,312 @@
+# Tests for HDM
+# like the example models, they need CCMSuite (with hdm.py and hrr.py installed) on the Python Path
+#     python -m unittest discover tests
+
+import unittest
+import copy
+import math
+import shutil
+import tempfile
+import numpy
+
+import ccm
+from ccm.lib.actr import *
+from ccm.lib.actr.hdm import HDM, MemoryStore
+from ccm.lib.hrr import HRR, RandomPool
+
+
+class StatsAgent(ACTR):
+    retrieval=Buffer()
+    DM=HDM(retrieval,N=64,seed=1,stats=True)
+
+    def init():
+        DM.add('a b c')
+        DM.get_activation('a b c')
+
+class Environment(ccm.Model):
+    pass
+
+
+class StatsTest(unittest.TestCase):
+    # ccm copies an HDM defined in a model class and wraps its methods,
+    # which must still be timed, on the copy
+    def test_timers_in_model(self):
+        env=Environment()
+        env.agent=StatsAgent()
+        env.run(limit=1)
+        dm=env.agent.DM
+        dm.add('d e f')
+        dm.get_activation('d e f')
+        dm.record(['a b c'],interval=0.1,samples=3)
+        env.run(limit=1)
+        self.assertTrue(dm.stats is dm.mem.stats)
+        self.assertTrue('d' in dm.mem)
+        self.assertEqual(dm.stats.calls['add'],2)
+        self.assertEqual(dm.stats.calls['get_activation'],2)
+        self.assertEqual(dm.stats.calls['get_activation_many'],3)
+        self.assertTrue(dm.stats.counters['convolutions']>0)
+
+
+class EncodingTest(unittest.TestCase):
+    # the batched encoders must build the same vectors as getUOG and getUOGwithSlots,
+    # even after the placeholder '?' has been redefined
+    def test_set_placeholder(self):
+        m=HDM(Buffer(),N=256,seed=2)
+        m.defineVectors(['k','l','m'])
+        m.defineVectors([['s','k'],['t','l']])
+        m.set('?',HRR(N=256))
+        vectors=m.encodeLeaveOneOut([['k','l','m']])[0]
+        for p,query in enumerate([['?','l','m'],['k','?','m'],['k','l','?']]):
+            self.assertTrue(numpy.allclose(vectors[p],m.getUOG(query).v))
+        vectors,spectra=m.encodeLeaveOneOutWithSlots([[['s','k'],['t','l']]])
+        for p,query in enumerate([[['s','?'],['t','l']],[['s','k'],['t','?']]]):
+            self.assertTrue(numpy.allclose(vectors[0,p],m.getUOGwithSlots(query).v))
+
+
+class CacheTest(unittest.TestCase):
+    # after set changes a vector, the cached open n-grams built from it are built again,
+    # and those that do not use it are kept
+    def test_set(self):
+        m=HDM(Buffer(),N=128,seed=6)
+        m.add('a b c')
+        m.add('s:a t:b')
+        m.add('d e f')
+        m.queryJustValues('a b ?')
+        m.queryWithSlots('s:? t:b')
+        m.queryJustValues('d ? f')
+        m.set('b',HRR(N=128))
+        self.assertFalse(('a','b','?') in m.ngrams.vectors)
+        self.assertTrue(('a','?','c') in m.ngrams.vectors)
+        self.assertFalse((('s','?'),('t','b')) in m.ngrams.vectors)
+        self.assertTrue(('d','?','f') in m.ngrams.vectors)
+        self.assertTrue(numpy.allclose(m.queryJustValues('a b ?').v,m.getUOG(['a','b','?']).v))
+        self.assertTrue(numpy.allclose(m.queryWithSlots('s:? t:b').v,m.getUOGwithSlots([['s','?'],['t','b']]).v))
+        for vector,query in zip(m.getLeaveOneOut(['a','b','c']),[['?','b','c'],['a','?','c'],['a','b','?']]):
+            self.assertTrue(numpy.allclose(vector.v,m.getUOG(query).v))
+        # every open n-gram uses the placeholder
+        m.set('?',HRR(N=128))
+        self.assertEqual(len(m.ngrams),0)
+        self.assertTrue(numpy.allclose(m.queryJustValues('d ? f').v,m.getUOG(['d','?','f']).v))
+
+
+class AddManyTest(unittest.TestCase):
+    chunks=['a b c','a d c','b a c','a b c','s:a t:b','s:c t:a u:d','a ?!c b','s:a t:?!b']
+
+    # add_many leaves memory as adding each chunk in turn does, in blocks of any size
+    def check(self,forgetting):
+        m=HDM(Buffer(),N=64,seed=1,forgetting=forgetting)
+        n=HDM(Buffer(),N=64,seed=1,forgetting=forgetting)
+        for chunk in self.chunks:
+            m.add(chunk)
+        n.add_many(self.chunks,block_size=3)
+        self.assertEqual(m.mem.keys(),n.mem.keys())
+        for value in m.mem.keys():
+            self.assertTrue(numpy.allclose(m.mem[value].v,n.mem[value].v,rtol=0,atol=1e-12))
+
+    def test_add_many(self):
+        self.check(1.0)
+
+    def test_forgetting(self):
+        self.check(0.5)
+
+
+class LazyTest(unittest.TestCase):
+    # rows that decay lazily (by the log-space clock) equal rows scaled at every step,
+    # also across renormalize and the renormalize forced by a large decay
+    def test_decay(self):
+        rng=numpy.random.RandomState(0)
+        m=MemoryStore(32,capacity=4,rng=RandomPool(0))
+        eager={}
+        values=['v%d' % i for i in range(10)]
+        for step in range(300):
+            value=values[rng.randint(10)]
+            x=rng.randn(32)
+            m.update(value,HRR(data=x),forgetting=0.9)
+            eager[value]=eager.get(value,numpy.zeros(32))*0.9+x
+            amount=rng.exponential(0.5) if step!=150 else 60.0
+            m.decay(amount)
+            for v in eager:
+                eager[v]=eager[v]*math.exp(-amount)
+            if step%37==0:
+                m.renormalize()
+        for v in eager:
+            scale=numpy.abs(eager[v]).max()
+            self.assertTrue(numpy.allclose(m[v].v/scale,eager[v]/scale,rtol=0,atol=1e-12))
+            self.assertAlmostEqual(m.norms[m.rows[v]]/scale,numpy.linalg.norm(eager[v])/scale)
+
+    # the noise drawn lazily has the variance of the noise added at every step, with decay,
+    # as has the eager noise (over 50 seeded runs, to within 5%)
+    def test_noise(self):
+        expected=0.1**2*math.exp(-3)+0.2**2*math.exp(-2)+0.3**2*math.exp(-1)+0.4**2
+        for lazy in [True,False]:
+            squared=[]
+            for seed in range(50):
+                m=MemoryStore(256,lazy_noise=lazy,rng=RandomPool(seed))
+                m['a']=HRR(data=numpy.zeros(256))
+                for scale in [0.1,0.2,0.3]:
+                    m.addNoise(scale)
+                    m.decay(0.5)
+                    m.renormalize()
+                m.addNoise(0.4)
+                squared.append(numpy.dot(m['a'].v,m['a'].v))
+            self.assertAlmostEqual(numpy.mean(squared)/expected,1.0,delta=0.05)
+
+
+class LSHTest(unittest.TestCase):
+    # z values also occur with v values, so they match x values less well than y values do
+    chunks=['x%d y%d' % (i,i) for i in range(60)]+['x%d z%d' % (i,i) for i in range(0,60,2)]+['v%d z%d' % (i,i) for i in range(0,60,2)]
+    queries=['x%d ?' % i for i in range(60)]+['x4 ?!y4','x6 ?!z6','q ?']
+
+    # the answers of request and request_many to queries, and to queries with require_new
+    # (the finst is filled by hand, since there is no model to schedule its removals)
+    def answers(self,**keys):
+        m=HDM(Buffer(),N=256,seed=1,threshold=-1,finst_size=0,**keys)
+        m.add_many(self.chunks)
+        recalled=[]
+        m.recall=lambda chunk,matches,request_number: recalled.append(chunk.activation)
+        m.fail=lambda request_number: recalled.append(None)
+        matches=list(m.request_many(self.queries)[0])
+        m.finst.obj=['y8','y9']
+        matches+=list(m.request_many(['x8 ?','x9 ?'],require_new=True)[0])
+        for query in self.queries:
+            m.request(query)
+        m.request('x8 ?',require_new=True)
+        return matches,recalled
+
+    # on a well separated memory, LSH finds what comparing to every row finds,
+    # honouring ! values, the finst and the threshold
+    def test_lsh(self):
+        exact,recalled=self.answers()
+        self.assertEqual(exact[:60],['y%d' % i for i in range(60)])
+        self.assertEqual(exact[60:],['z4','y6',None,'z8',None])
+        self.assertIsNone(recalled[-2])
+        self.assertIsNotNone(recalled[-1])
+        approximate,approximateRecalled=self.answers(lsh_tables=8,lsh_bits=8)
+        self.assertEqual(approximate,exact)
+        self.assertEqual([a is None for a in approximateRecalled],[a is None for a in recalled])
+        self.assertTrue(numpy.allclose([a for a in approximateRecalled if a is not None],[a for a in recalled if a is not None]))
+
+
+class StoreTest(unittest.TestCase):
+    chunks=['a%d b%d c%d' % (i,i%7,i%5) for i in range(60)]+['s:a%d t:b%d' % (i,i%3) for i in range(20)]
+    probes=['a3 b3 c3','a3 b4 c3','a10 ? c0','? b2 c2','s:a4 t:?']
+
+    def setUp(self):
+        self.path=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def results(self,**keys):
+        m=HDM(Buffer(),N=64,seed=9,forgetting=0.9,**keys)
+        m.add_many(self.chunks[:40])
+        for chunk in self.chunks[40:]:
+            m.add(chunk)
+        matches,cosines,activations,latencies=m.request_many(self.probes)
+        return m,list(matches),cosines,m.get_activation_many(self.probes)
+
+    def check(self,**keys):
+        m,matches,cosines,activations=self.results()
+        other,otherMatches,otherCosines,otherActivations=self.results(**keys)
+        self.assertEqual(otherMatches,matches)
+        self.assertTrue(numpy.allclose(otherCosines,cosines))
+        self.assertTrue(numpy.allclose(otherActivations,activations))
+        for value in m.mem.keys():
+            self.assertTrue(numpy.allclose(other.mem[value].v,m.mem[value].v))
+        return other
+
+    # an out-of-core memory, in small files and with a small write buffer, gives the results of one in RAM
+    def test_disk(self):
+        self.check(disk_path=self.path,block_rows=16,buffer_rows=8)
+
+    # as does a memory compared to queries in shards, on four threads
+    def test_workers(self):
+        m=self.check(workers=4,shard_rows=8)
+        self.assertTrue(m.mem.pool is not None)
+        m.close()
+        self.assertTrue(m.mem.pool is None)
+
+    # a copy of an out-of-core memory (as ccm makes for each agent) has files of its own,
+    # and a copy of a memory whose threads have started starts its own
+    def test_copy(self):
+        m=self.check(disk_path=self.path,block_rows=16,buffer_rows=8,workers=4,shard_rows=8)
+        before=m.mem['a3'].v.copy()
+        m2=copy.deepcopy(m)
+        try:
+            self.assertNotEqual(m2.mem.vectors.path,m.mem.vectors.path)
+            self.assertEqual(m2.env.matrix.path,m2.mem.vectors.path)
+            self.assertTrue(m2.mem.pool is None)
+            m2.add_many(['a3 x%d' % i for i in range(40)])
+            self.assertTrue(numpy.allclose(m.mem['a3'].v,before))
+            self.assertFalse(numpy.allclose(m2.mem['a3'].v,before))
+            self.assertFalse('x1' in m.mem)
+            m2.close()
+            m.close()
+        finally:
+            shutil.rmtree(m2.mem.vectors.path)
+
+
+class InhibitionTest(unittest.TestCase):
+    # values inhibited by the probes of get_activation_many must not leak into later requests
+    def test_get_activation_many(self):
+        m=HDM(Buffer(),N=64,seed=3)
+        m.add('a b c')
+        m.inhibited=['x']
+        m.get_activation_many(['a b ?!c','a ?!b c'])
+        self.assertEqual(m.inhibited,['x'])
+
+    # a query whose every value is inhibited fails cleanly, with or without an index
+    def test_all_excluded(self):
+        for keys in [{},dict(lsh_tables=4,lsh_bits=4)]:
+            m=HDM(Buffer(),N=64,seed=3,**keys)
+            m.add('a b c')
+            matches,cosines,activations,latencies=m.request_many(['a b ?!a!b!c','a ?!a!b!c c','a b ?'])
+            self.assertEqual(list(matches),[None,None,'c'])
+            self.assertFalse(numpy.any(numpy.isnan(activations)))
+            self.assertEqual(list(activations[:2]),[-numpy.inf,-numpy.inf])
+            self.assertEqual(latencies[0],latencies[1])
+            self.assertFalse(numpy.any(numpy.isnan(m.get_activation_many(['a b ?!a!b!c','a ?!a!b!c c'],logodds=True))))
+
+
+class SaveTest(unittest.TestCase):
+    # a saved and loaded memory retrieves the same values, as str
+    def test_round_trip(self):
+        path=tempfile.mkdtemp()
+        try:
+            m=HDM(Buffer(),N=256,seed=4)
+            m.add('a b c')
+            m.add('slot1:d slot2:e')
+            m.save(path)
+            n=HDM(Buffer(),N=256,seed=5)
+            n.load(path)
+            matches,cosines,activations,latencies=n.request_many(['a b ?','slot1:d slot2:?'])
+            self.assertEqual(list(matches),['c','e'])
+            self.assertTrue(all(type(match) is str for match in matches))
+        finally:
+            shutil.rmtree(path)
+
+
+class SeedTest(unittest.TestCase):
+    # an HDM made before its seed is known and then reseeded is the same as one made with the seed
+    def test_reseed(self):
+        m=HDM(Buffer(),N=64)
+        m.add('a b c')
+        m.add('s:d t:e')
+        m.reseed(7)
+        n=HDM(Buffer(),N=64,seed=7)
+        self.assertEqual(len(m.mem),0)
+        self.assertTrue(numpy.allclose(m.env['?'].v,n.env['?'].v))
+        self.assertTrue(numpy.all(m.left==n.left))
+        # two unseeded memories with the same history give the same results once reseeded
+        results=[]
+        for memory in [HDM(Buffer(),N=64),HDM(Buffer(),N=64)]:
+            memory.add('a b c')
+            memory.reseed(8)
+            memory.add('a b c')
+            memory.add('a f g')
+            results.append(memory.get_activation_many(['a b c','a f c','a ? g']))
+        self.assertTrue(numpy.allclose(results[0],results[1]))
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# Tests for HRR, SparseHRR and HRRArray
+#     python -m unittest discover tests
+
+import unittest
+import numpy
+
+from math import sin, pi, acos
+
+from ccm.lib.hrr import HRR, SparseHRR, HRRArray, Cleanup, Vocabulary
+
+
+class SparseTest(unittest.TestCase):
+    def setUp(self):
+        rng=numpy.random.RandomState(0)
+        self.a=HRR(data=rng.randn(256))
+        v=rng.randn(256)
+        v[rng.rand(256)>0.1]=0
+        self.s=SparseHRR(hrr=HRR(data=v))
+        self.d=self.s.dense()
+
+    # a SparseHRR gives the same results as its dense vector, on either side of an HRR
+    def test_add(self):
+        self.assertTrue(numpy.allclose((self.a+self.s).v,(self.a+self.d).v))
+        self.assertTrue(numpy.allclose((self.s+self.a).v,(self.a+self.d).v))
+
+    def test_sub(self):
+        self.assertTrue(numpy.allclose((self.a-self.s).v,(self.a-self.d).v))
+        self.assertTrue(numpy.allclose((self.s-self.a).v,(self.d-self.a).v))
+
+    def test_inplace(self):
+        b=self.a.copy()
+        b+=self.s
+        self.assertTrue(numpy.allclose(b.v,(self.a+self.d).v))
+        b-=self.s
+        self.assertTrue(numpy.allclose(b.v,self.a.v))
+
+    def test_mul(self):
+        self.assertTrue(numpy.allclose((self.a*self.s).v,(self.a*self.d).v))
+        self.assertTrue(numpy.allclose((self.s*self.a).v,(self.a*self.d).v))
+        self.assertTrue(numpy.allclose(self.a.convolve(self.s).v,self.a.convolve(self.d).v))
+
+    def test_compare(self):
+        self.assertAlmostEqual(self.a.compare(self.s),self.a.compare(self.d))
+        self.assertAlmostEqual(self.s.compare(self.a),self.a.compare(self.d))
+        self.assertAlmostEqual(self.a.dot(self.s),self.a.dot(self.d))
+        self.assertAlmostEqual(self.s.dot(self.a),self.a.dot(self.d))
+
+
+class ConvolveTest(unittest.TestCase):
+    # binding integer vectors gives the float result, as numpy's FFT does, not a truncated one
+    def test_integer_data(self):
+        rng=numpy.random.RandomState(1)
+        a=HRR(data=rng.randint(-5,6,64))
+        b=HRR(data=rng.randint(-5,6,64))
+        exact=numpy.fft.irfft(numpy.fft.rfft(a.v)*numpy.fft.rfft(b.v),64)
+        self.assertTrue(numpy.allclose(a.convolve(b).v,exact))
+        self.assertTrue(numpy.allclose((a*b).v,exact/numpy.linalg.norm(exact)))
+        c=HRR(data=a.v.copy())
+        c*=b
+        self.assertTrue(numpy.allclose(c.v,exact))
+        self.assertTrue(numpy.allclose(HRRArray(data=numpy.array([a.v,a.v])).convolve(b).v,[exact,exact]))
+
+
+# the straightforward computations that Cleanup, Vocabulary.text and prob_cleanup replace
+def clean(hrrs,hrr,limit=None):
+    best=None
+    best_v=None
+    for v in hrrs:
+        c=hrr.compare(v)
+        if limit is not None and c<limit: continue
+        if best is None or c>best:
+            best=c
+            best_v=v
+    return best_v
+
+def text(vocabulary,v):
+    matches=[]
+    names=sorted(vocabulary.hrr.keys())
+    names.remove('I')
+    for i in range(len(names)):
+        c=vocabulary.hrr[names[i]].compare(v)
+        if c>0: matches.append((c,names[i]))
+        for j in range(i+1,len(names)):
+            c=(vocabulary.hrr[names[i]]*vocabulary.hrr[names[j]]).compare(v)
+            if c>0: matches.append((c,'%s*%s' % (names[i],names[j])))
+    matches.sort()
+    matches.reverse()
+    r=[]
+    for m in matches:
+        if m[0]>0.3: r.append(m)
+        elif len(r)<2: r.append(m)
+        else: break
+    return '+'.join(['%s(%0.2f)' % (k,c) for (c,k) in r])
+
+def prob_cleanup(dimensions,compare,vocab_size,steps=10000):
+    def prob_func(angle):
+        return sin(angle)**(dimensions-2)
+    angle=acos(compare)
+    num=0
+    dnum=angle/steps
+    denom=0
+    ddenom=pi/steps
+    for i in range(steps):
+        num+=prob_func(pi-angle+dnum*i)
+        denom+=prob_func(ddenom*i)
+    return (1-num*dnum/(denom*ddenom))**vocab_size
+
+
+class CleanupTest(unittest.TestCase):
+    def setUp(self):
+        rng=numpy.random.RandomState(2)
+        self.hrrs=[HRR(data=rng.randn(64)) for i in range(40)]
+        self.probes=[self.hrrs[i]+HRR(data=rng.randn(64)) for i in range(0,40,4)]+[HRR(data=rng.randn(64)) for i in range(10)]
+
+    # the cleanup memory (which grows past its capacity here) ranks vectors as comparing each in turn does
+    def test_clean(self):
+        for limit in [None,0.3]:
+            c=Cleanup(limit=limit,capacity=4)
+            for h in self.hrrs:
+                c.add(h)
+            for probe in self.probes:
+                self.assertTrue(c.clean(probe) is clean(self.hrrs,probe,limit))
+                cosines=[probe.compare(h) for h in self.hrrs]
+                self.assertTrue(numpy.allclose([x for x,h in c.all(probe)],cosines))
+                self.assertEqual([h for x,h in c.all(probe)],self.hrrs)
+                ranked=sorted([(x,i) for i,x in enumerate(cosines) if limit is None or x>=limit],key=lambda pair: -pair[0])[:5]
+                self.assertEqual([h for x,h in c.top(probe,5)],[self.hrrs[i] for x,i in ranked])
+
+
+class VocabularyTest(unittest.TestCase):
+    # the terms of the text of a probe (terms with equal cosines may come in either order)
+    def terms(self,text):
+        return sorted(text.split('+'))
+
+    # text gives the terms the comparison of the probe to every atom and pair of atoms gives,
+    # as atoms are added, and after an atom is replaced
+    def test_text(self):
+        v=Vocabulary(64,seed=3)
+        names=['a%d' % i for i in range(12)]
+        for name in names:
+            v[name]
+        probes=[v['a1']*v['a2']+v['a3'],v['a4'],v['a5']*v['a6'],v['a7']+v['a8']*v['a9']+v['a10']]
+        for probe in probes:
+            self.assertEqual(self.terms(v.text(probe,block_size=5)),self.terms(text(v,probe)))
+        v['b']
+        v['c']
+        probes.append(v['b']*v['a0']+v['c'])
+        v.hrr['a3']=HRR(64)
+        for probe in probes:
+            self.assertEqual(self.terms(v.text(probe,block_size=5)),self.terms(text(v,probe)))
+
+    # the probabilities of a correct cleanup agree with integrating sin(angle)^(D-2) step by step
+    def test_prob_cleanup(self):
+        v=Vocabulary(64,seed=3)
+        for compare in [0.1,0.3,0.5,0.9]:
+            for vocab_size in [1,10,1000]:
+                self.assertAlmostEqual(v.prob_cleanup(compare,vocab_size),prob_cleanup(64,compare,vocab_size),places=3)
+        probabilities=v.prob_cleanup(numpy.array([0.1,0.5]),numpy.array([10,1000]))
+        self.assertTrue(numpy.allclose(probabilities,[prob_cleanup(64,0.1,10),prob_cleanup(64,0.5,1000)],atol=1e-3))
+
+
+if __name__=='__main__':
+    unittest.main()